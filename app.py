@@ -1,23 +1,31 @@
-from flask import Flask, render_template, request, flash, redirect, url_for, jsonify, session
+from flask import Flask, render_template, request, flash, redirect, url_for, jsonify, session, Response, Markup
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileRequired, FileAllowed
-from wtforms import StringField, TextAreaField, SubmitField, SelectField, PasswordField
+from wtforms import StringField, TextAreaField, SubmitField, SelectField, PasswordField, HiddenField
 from wtforms.validators import DataRequired, Email, Optional
 from bulk_email_sender import BulkEmailSender
 from sendgrid_analytics import SendGridAnalytics
+from template_store import CustomTemplateStore
+from progress_events import progress_bus, ProgressTracker
+from event_webhook import event_store, verify_webhook_request
+from campaign_analytics import campaign_analytics, DIMENSIONS
+from domain_throttle import DomainThrottledSender
+from recipient_history import recipient_history
+from upload_spool import SpooledUploadRequest, allow_large_upload
+from retry_queue import retry_queue, is_transient_failure
+from mail_transport import get_transport, SendResult
+from failure_report import failure_report
+from background import LOGS_DIR
+from campaign_export import BATCH_NAME_PATTERN, batch_summary_path, iter_summary, iter_csv as iter_outcomes_csv, write_parquet
 import os
 from dotenv import load_dotenv
-import plotly.graph_objects as go
 from datetime import datetime, timedelta
 import logging
-import pandas as pd
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Email, To, Content
-import json
-import pytz
 import uuid
 import glob
 import re
+import io
+import csv
 from functools import wraps
 
 # Configure logging
@@ -27,16 +35,19 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 app = Flask(__name__)
+app.request_class = SpooledUploadRequest  # Large uploads are spooled to disk in chunks
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-secret-key-here')
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max request size
+app.config['MAX_UPLOAD_LENGTH'] = int(os.getenv('MAX_UPLOAD_MB', 500)) * 1024 * 1024  # Recipient file uploads
+app.config['UPLOAD_CHUNK_ROWS'] = int(os.getenv('UPLOAD_CHUNK_ROWS', 50000))  # Rows parsed at a time
 
-# Create custom_templates directory if it doesn't exist
-custom_templates_dir = os.path.join('templates', 'custom_templates')
-if not os.path.exists(custom_templates_dir):
-    os.makedirs(custom_templates_dir)
+app.config['SEND_WORKERS'] = int(os.getenv('SEND_WORKERS', 8))  # Concurrent sends per campaign
+app.config['CUSTOM_TEMPLATE_MAX_COUNT'] = int(os.getenv('CUSTOM_TEMPLATE_MAX_COUNT', 200))
+app.config['CUSTOM_TEMPLATE_MAX_AGE_DAYS'] = int(os.getenv('CUSTOM_TEMPLATE_MAX_AGE_DAYS', 90))
+app.config['LOG_TAIL_KB'] = int(os.getenv('LOG_TAIL_KB', 64))  # End of a campaign log shown on Batch Activity
 
-# Set Pakistan timezone
-PAKISTAN_TZ = pytz.timezone('Asia/Karachi')
+# Content-addressed store for uploaded templates (creates templates/custom_templates)
+template_store = CustomTemplateStore()
 
 # Predefined users (in a real application, these would be stored in a database)
 USERS = {
@@ -108,6 +119,8 @@ class EmailForm(FlaskForm):
         ('subject3', 'Follow-up: Enroll {name} for Community Solar & Start Saving'),
         ('subject4', 'Reminder: Enroll {name} for Community Solar & Start Saving')
     ], validators=[Optional()])
+    # Client-generated id used to watch this submission's progress over SSE
+    progress_id = HiddenField('Progress ID', validators=[Optional()])
     submit = SubmitField('Send Campaign')
 
     # Predefined headers for each template
@@ -131,7 +144,19 @@ class EmailForm(FlaskForm):
         # Set initial subject based on default template
         self.subject.data = self.TEMPLATE_HEADERS['email_template.html'].format(name='')
 
+@app.before_first_request
+def start_retry_worker():
+    # Pick up retries left pending by an earlier run of this worker
+    retry_queue.ensure_started()
+
+@app.errorhandler(413)
+def request_entity_too_large(error):
+    limit_mb = (request.max_content_length or 0) // (1024 * 1024)
+    flash(f'The uploaded file is too large. The limit is {limit_mb}MB.', 'error')
+    return redirect(url_for('index'))
+
 @app.route('/', methods=['GET', 'POST'])
+@allow_large_upload
 @login_required
 def index():
     form = EmailForm()
@@ -145,21 +170,20 @@ def index():
             return jsonify({'error': 'Invalid template'}), 400
 
         if form.validate_on_submit():
+            progress_tracker = None
+            email_sender = None
             try:
-                # Initialize BulkEmailSender for logging
-                email_sender = BulkEmailSender()
                 logger.info("Starting new email campaign")
                 
                 # Get recipients from either text area or file
                 recipients = []
-                email_name_map = {}  # Dictionary to store email-name mappings
+                # Names found in an uploaded file; everyone else is addressed by email username
+                # (see personalize()), so manual entries need no mapping at all
+                email_name_map = {}
                 
                 if form.recipients.data:
                     logger.info("Processing manual email entries")
                     recipients.extend([email.strip() for email in form.recipients.data.split('\n') if email.strip()])
-                    # For manual entries, use email username as name
-                    for email in recipients:
-                        email_name_map[email] = email.split('@')[0]
                     logger.info(f"Processed {len(recipients)} manual email entries")
                 
                 if form.excel_file.data:
@@ -168,10 +192,6 @@ def index():
                     recipients.extend(file_emails)
                     # Update the email-name mapping with file data
                     email_name_map.update(file_email_name_map)
-                    # For any emails without names, use email username
-                    for email in file_emails:
-                        if email not in email_name_map:
-                            email_name_map[email] = email.split('@')[0]
                     logger.info(f"Processed {len(file_emails)} emails from file")
                 
                 if not recipients:
@@ -179,8 +199,8 @@ def index():
                     flash('Please provide recipients either in the text area or upload a file.', 'error')
                     return redirect(url_for('index'))
                 
-                # Remove duplicates and validate emails
-                recipients = list(set(recipients))
+                # Remove duplicates (keeping first-seen order) and validate emails
+                recipients = list(dict.fromkeys(recipients))
                 invalid_emails = [email for email in recipients if not '@' in email]
                 if invalid_emails:
                     logger.warning(f"Found invalid email addresses: {invalid_emails}")
@@ -204,23 +224,14 @@ def index():
                         flash('Please select a subject for your custom template.', 'error')
                         return redirect(url_for('index'))
                     
-                    # Save custom template
-                    custom_template_name = f"custom_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html"
-                    template_path = os.path.join('templates', 'custom_templates', custom_template_name)
-                    form.custom_template.data.save(template_path)
-                    
                     # Get the selected subject template
                     custom_subject = form.CUSTOM_SUBJECTS[form.custom_subject.data]
                     
-                    # Save custom subject
-                    subjects_file = os.path.join('templates', 'custom_templates', 'subjects.json')
-                    subjects = {}
-                    if os.path.exists(subjects_file):
-                        with open(subjects_file, 'r') as f:
-                            subjects = json.load(f)
-                    subjects[custom_template_name] = custom_subject
-                    with open(subjects_file, 'w') as f:
-                        json.dump(subjects, f, indent=4)
+                    # Save custom template (identical uploads share one stored file)
+                    template_path = template_store.save(form.custom_template.data.read(), custom_subject)
+                    template_store.evict(max_templates=app.config['CUSTOM_TEMPLATE_MAX_COUNT'],
+                                         max_age_days=app.config['CUSTOM_TEMPLATE_MAX_AGE_DAYS'],
+                                         in_use=retry_queue.pending_template_paths())
                 
                 # Use the verified sender email
                 sender_email = "origination@clean-earth.org"
@@ -229,12 +240,16 @@ def index():
                 with open(template_path, 'r') as file:
                     email_content = file.read()
                 
-                # Send emails immediately
-                sg = SendGridAPIClient(os.getenv('SENDGRID_API_KEY'))
-                from_email = Email(sender_email, "Clean Earth Renewables")
+                # Initialize BulkEmailSender for logging once the request is known to be valid;
+                # it opens the campaign's log file, which the finally block below closes
+                email_sender = BulkEmailSender()
+                
+                # Send emails immediately through the configured transport (MAIL_TRANSPORT)
+                transport = get_transport()
                 
                 success_count = 0
-                failed_recipients = []
+                failed_count = 0
+                retrying_count = 0
                 
                 # Update batch data
                 email_sender.batch_data.update({
@@ -245,8 +260,22 @@ def index():
                     'file_name': form.excel_file.data.filename if form.excel_file.data else None
                 })
                 
-                for recipient in recipients:
-                    to_email = To(recipient)
+                # Publish per-batch progress for /campaign/progress watchers
+                progress_id = form.progress_id.data
+                if not progress_id or not re.fullmatch(r'[A-Za-z0-9-]{1,64}', progress_id):
+                    progress_id = None
+                progress_tracker = ProgressTracker(
+                    progress_bus,
+                    email_sender.batch_data['campaign_id'],
+                    len(recipients),
+                    channel=progress_id,
+                    template=email_sender.batch_data['template'],
+                    subject=email_sender.batch_data['subject']
+                )
+                progress_tracker.start()
+                
+                def personalize(recipient):
+                    """Return the recipient's name and subject line"""
                     # Get the name for this recipient from the mapping
                     name = email_name_map.get(recipient, recipient.split('@')[0])
                     
@@ -255,64 +284,102 @@ def index():
                         subject = form.TEMPLATE_HEADERS[form.template.data].format(name=name)
                     else:
                         subject = custom_subject.format(name=name)
+                    return name, subject
+                
+                custom_args = {
+                    'campaign_id': email_sender.batch_data['campaign_id'],
+                    'template': email_sender.batch_data['template']
+                }
+                
+                def send_one(recipient):
+                    """Build and send one message; runs on a worker thread"""
+                    name, subject = personalize(recipient)
                     
                     # Replace {Name} in the email content with the recipient's name
-                    personalized_content = email_content.replace('{Name}', name)
-                    content = Content("text/html", personalized_content)
-                    mail = Mail(from_email, to_email, subject, content)
-                    
-                    try:
-                        response = sg.send(mail)
-                        if response.status_code == 202:
-                            success_count += 1
-                            logger.info(f"Email sent successfully to {recipient}")
-                            email_sender.batch_data['successful_emails'] += 1
-                            email_sender.batch_data['recipients'].append({
-                                'email': recipient,
-                                'status': 'success',
-                                'timestamp': datetime.now().isoformat(),
-                                'response_code': response.status_code
-                            })
+                    return transport.send({
+                        'from_email': sender_email,
+                        'from_name': "Clean Earth Renewables",
+                        'to': recipient,
+                        'subject': subject,
+                        'html': email_content.replace('{Name}', name),
+                        'custom_args': custom_args
+                    })
+                
+                # Recipients are interleaved by domain and sent with per-domain rate/concurrency limits;
+                # results are recorded here on the request thread as they complete
+                # A recipient whose message cannot even be built (send_one raised) is a permanent failure
+                throttled_sender = DomainThrottledSender(max_workers=app.config['SEND_WORKERS'])
+                results = throttled_sender.run(recipients, send_one,
+                                               on_error=lambda recipient, e: SendResult(None, str(e), None, False))
+                for recipient, (status_code, error, message_id, transient) in results:
+                    if error is None:
+                        success_count += 1
+                        progress_tracker.record(True)
+                        logger.info(f"Email sent successfully to {recipient}")
+                        email_sender.record_success(recipient, status_code, message_id)
+                    else:
+                        logger.error(f"Error sending email to {recipient}: {error}")
+                        progress_tracker.record(False)
+                        
+                        # Network errors, 429s and 5xx responses are retried in the background
+                        transient = is_transient_failure(status_code, error, transient)
+                        retry_message = None
+                        if transient:
+                            retrying_count += 1
+                            name, subject = personalize(recipient)
+                            retry_message = {
+                                'from_email': sender_email,
+                                'from_name': "Clean Earth Renewables",
+                                'to': recipient,
+                                'subject': subject,
+                                'template_path': template_path,
+                                'name': name,
+                                'custom_args': custom_args
+                            }
                         else:
-                            failed_recipients.append(f"{recipient} (Status: {response.status_code})")
-                            logger.error(f"Failed to send email to {recipient}: {response.status_code}")
-                            email_sender.batch_data['failed_emails'] += 1
-                            email_sender.batch_data['recipients'].append({
-                                'email': recipient,
-                                'status': 'failed',
-                                'timestamp': datetime.now().isoformat(),
-                                'error': f"Status code: {response.status_code}"
-                            })
-                    except Exception as e:
-                        failed_recipients.append(f"{recipient} ({str(e)})")
-                        logger.error(f"Error sending email to {recipient}: {str(e)}")
-                        email_sender.batch_data['failed_emails'] += 1
-                        email_sender.batch_data['recipients'].append({
-                            'email': recipient,
-                            'status': 'failed',
-                            'timestamp': datetime.now().isoformat(),
-                            'error': str(e)
-                        })
-                        continue
+                            failed_count += 1
+                        email_sender.record_failure(recipient, error, transient, retry_message)
                 
                 # Save batch summary
                 email_sender.save_batch_summary()
+                progress_tracker.finish()
                 
                 # Show appropriate success/error messages
                 if success_count > 0:
                     flash(f'Successfully sent emails to {success_count} recipients!', 'success')
-                if failed_recipients:
-                    flash(f'Failed to send campaign emails to: {", ".join(failed_recipients)}', 'error')
+                # Failures stay in the batch summary; the flash (stored in the session cookie) only links to them
+                report_url = url_for('batch_failures', batch_name=email_sender.batch_name)
+                if failed_count:
+                    flash(Markup('Failed to send to {} recipients. <a href="{}">View the failure report</a>')
+                          .format(failed_count, report_url), 'error')
+                if retrying_count:
+                    flash(Markup('{} recipients hit a temporary error and will be retried automatically. '
+                                 '<a href="{}">Track them</a>').format(retrying_count, report_url), 'warning')
                 
                 return redirect(url_for('index'))
                 
             except Exception as e:
                 logger.error(f"Error in email sending process: {str(e)}", exc_info=True)
+                if progress_tracker:
+                    progress_tracker.finish('failed')
                 flash(f'Error sending emails: {str(e)}', 'error')
                 return redirect(url_for('index'))
+            finally:
+                if email_sender:
+                    email_sender.close()
     
     return render_template('index.html', form=form)
 
+@app.route('/campaign/progress')
+@app.route('/campaign/progress/<channel>')
+@login_required
+def campaign_progress(channel=None):
+    """Stream campaign progress as Server-Sent Events (all campaigns if no channel is given)"""
+    return Response(progress_bus.stream(channel), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 def get_email_template(template_name='email_template.html'):
     """Get the email template."""
     template_path = os.path.join('templates', template_name)
@@ -337,110 +404,150 @@ def get_email_template(template_name='email_template.html'):
         </html>
         """
 
-def extract_emails_from_file(file):
-    try:
-        # Get file extension
-        filename = file.filename
-        file_ext = filename.rsplit('.', 1)[1].lower()
-        logger.debug(f"Processing file: {filename} with extension: {file_ext}")
-        
-        # Read file based on extension
-        if file_ext in ['xlsx', 'xls']:
-            df = pd.read_excel(file)
-        elif file_ext == 'csv':
-            # Try different encodings for CSV
-            try:
-                df = pd.read_csv(file)
-            except UnicodeDecodeError:
-                file.seek(0)  # Reset file pointer
-                df = pd.read_csv(file, encoding='latin1')
-        else:
-            raise ValueError("Unsupported file format")
-        
-        logger.debug(f"File columns: {df.columns.tolist()}")
-        
+EMAIL_PATTERN = r'[\w\.-]+@[\w\.-]+\.\w+'
+EMAIL_COLUMN_VARIATIONS = ['email', 'e-mail', 'mail', 'email address', 'emailaddress']
+NAME_COLUMN_VARIATIONS = ['name', 'first name', 'firstname', 'full name', 'fullname', 'last name', 'lastname']
+
+def find_recipient_columns(columns):
+    """Return the (email_columns, name_columns) among lowercased column names"""
+    email_columns = [col for col in columns if any(variation in col for variation in EMAIL_COLUMN_VARIATIONS)]
+    name_columns = [col for col in columns if any(variation in col for variation in NAME_COLUMN_VARIATIONS)]
+    return email_columns, name_columns
+
+def _recipient_column_positions(header):
+    """Positions of the email/name columns in a header, or None to keep every column"""
+    names = [str(name).lower() for name in header]
+    email_columns, name_columns = find_recipient_columns(names)
+    if not email_columns:
+        return None  # Every column is searched for addresses
+    wanted = set(email_columns) | set(name_columns)
+    return [i for i, name in enumerate(names) if name in wanted]
+
+def iter_file_chunks(stream, file_ext, encoding=None):
+    """
+    Yield an uploaded file as DataFrames of at most UPLOAD_CHUNK_ROWS rows,
+    reading directly from its (spooled) upload stream. Only the email and name
+    columns are loaded when the header has them.
+    """
+    import pandas as pd  # Loaded on first upload to keep app startup fast
+
+    chunk_rows = app.config['UPLOAD_CHUNK_ROWS']
+    if file_ext == 'csv':
+        header = pd.read_csv(stream, nrows=0, encoding=encoding).columns
+        stream.seek(0)
+        yield from pd.read_csv(stream, chunksize=chunk_rows, dtype=str, encoding=encoding,
+                               usecols=_recipient_column_positions(header))
+    elif file_ext == 'xlsx':
+        # Read-only mode streams rows from the zip instead of building the whole sheet
+        from openpyxl import load_workbook
+        workbook = load_workbook(stream, read_only=True, data_only=True)
+        try:
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                return
+            header = [str(name) if name is not None else f'Unnamed: {i}' for i, name in enumerate(header)]
+            positions = _recipient_column_positions(header) or list(range(len(header)))
+            columns = [header[i] for i in positions]
+            block = []
+            for row in rows:
+                block.append([row[i] if i < len(row) else None for i in positions])
+                if len(block) == chunk_rows:
+                    yield pd.DataFrame(block, columns=columns, dtype=object)
+                    block = []
+            if block:
+                yield pd.DataFrame(block, columns=columns, dtype=object)
+        finally:
+            workbook.close()
+    elif file_ext == 'xls':
+        yield pd.read_excel(stream, dtype=str)
+    else:
+        raise ValueError("Unsupported file format")
+
+def collect_emails_from_chunks(chunks):
+    """Find email (and name) columns in the first chunk and collect them from every chunk"""
+    import pandas as pd
+
+    emails = {}   # Ordered set of addresses
+    names = {}    # Address -> name from the first email column
+    email_columns = name_col = None
+    
+    for df in chunks:
         # Convert column names to lowercase for case-insensitive matching
-        df.columns = df.columns.str.lower()
-        
-        # Look for columns that might contain email addresses and names
-        email_columns = []
-        name_columns = []
-        email_variations = ['email', 'e-mail', 'mail', 'email address', 'emailaddress']
-        name_variations = ['name', 'first name', 'firstname', 'full name', 'fullname', 'last name', 'lastname']
+        df.columns = df.columns.astype(str).str.lower()
         
-        # First, look for exact matches
-        for col in df.columns:
-            if any(variation in col for variation in email_variations):
-                email_columns.append(col)
-                logger.debug(f"Found email column: {col}")
-            if any(variation in col for variation in name_variations):
-                name_columns.append(col)
-                logger.debug(f"Found name column: {col}")
+        if email_columns is None:
+            logger.debug(f"File columns: {df.columns.tolist()}")
+            email_columns, name_columns = find_recipient_columns(df.columns)
+            logger.debug(f"Found email columns: {email_columns}, name columns: {name_columns}")
+            if name_columns:
+                # Try to combine first name and last name if both exist
+                first_name_col = next((col for col in name_columns if 'first' in col), None)
+                last_name_col = next((col for col in name_columns if 'last' in col), None)
+                name_col = (first_name_col, last_name_col) if first_name_col and last_name_col else name_columns[0]
         
-        # If no email columns found, try to find columns containing email addresses
+        # If no email columns found, search every column for email-like patterns
         if not email_columns:
-            logger.debug("No email columns found, searching all columns for email patterns")
-            all_emails = []
             for col in df.columns:
-                # Convert column to string and find email-like patterns
-                emails = df[col].astype(str).str.extractall(r'[\w\.-]+@[\w\.-]+\.\w+')[0].unique()
-                if len(emails) > 0:  # If emails found in this column
-                    all_emails.extend(emails)
-                    logger.debug(f"Found emails in column {col}: {len(emails)} emails")
-            return list(set(all_emails)), {}  # Return empty dict for names if none found
+                for email in df[col].dropna().astype(str).str.extractall(f'({EMAIL_PATTERN})')[0].unique():
+                    emails[email] = None
+            continue
         
-        # If email columns are found, use them
-        emails = []
-        email_name_map = {}
-        
-        # Process emails
-        for col in email_columns:
-            # Clean the email addresses
+        for i, col in enumerate(email_columns):
+            # Clean the email addresses and drop any non-email entries
             col_emails = df[col].dropna().astype(str).str.strip()
-            # Remove any non-email entries
-            valid_emails = col_emails[col_emails.str.contains(r'^[\w\.-]+@[\w\.-]+\.\w+$')]
-            emails.extend(valid_emails.tolist())
-            logger.debug(f"Processed {len(valid_emails)} valid emails from column {col}")
-        
-        # Process names
-        if name_columns:
-            # Try to combine first name and last name if both exist
-            first_name_col = next((col for col in name_columns if 'first' in col), None)
-            last_name_col = next((col for col in name_columns if 'last' in col), None)
+            valid = col_emails.str.contains(f'^{EMAIL_PATTERN}$')
+            valid_emails = col_emails[valid]
+            emails.update(dict.fromkeys(valid_emails.tolist()))
             
-            if first_name_col and last_name_col:
-                # Combine first and last names
-                df['full_name'] = df[first_name_col].fillna('') + ' ' + df[last_name_col].fillna('')
-                name_col = 'full_name'
-            else:
-                # Use the first name column found
-                name_col = name_columns[0]
-            
-            # Create email-name mapping
-            for email in emails:
-                # Find the row containing this email
-                email_row = df[df[email_columns[0]] == email]
-                if not email_row.empty:
-                    name = email_row[name_col].iloc[0]
-                    if pd.notna(name) and str(name).strip():
-                        email_name_map[email] = str(name).strip()
-                    else:
-                        email_name_map[email] = email.split('@')[0]
+            # Names come from the row where the address first appears in the first email column
+            if i == 0 and name_col is not None:
+                if isinstance(name_col, tuple):
+                    chunk_names = (df[name_col[0]].fillna('').astype(str) + ' ' +
+                                   df[name_col[1]].fillna('').astype(str))
                 else:
-                    email_name_map[email] = email.split('@')[0]
-            
-            logger.debug(f"Created email-name mapping with {len(email_name_map)} entries")
-        else:
-            # If no name columns found, use email usernames
-            for email in emails:
-                email_name_map[email] = email.split('@')[0]
+                    chunk_names = df[name_col]
+                pairs = pd.DataFrame({'email': valid_emails, 'name': chunk_names.loc[valid_emails.index]})
+                pairs = pairs.drop_duplicates('email')
+                for email, name in zip(pairs['email'].tolist(), pairs['name'].tolist()):
+                    if email not in names:
+                        names[email] = str(name).strip() if pd.notna(name) else ''
+    
+    if not email_columns:
+        logger.debug(f"Found {len(emails)} emails by pattern search")
+        return list(emails), {}  # Return empty dict for names if none found
+    
+    # Only real names are kept; senders fall back to the email username for everyone else
+    email_name_map = {email: name for email, name in names.items() if name}
+    logger.debug(f"Created email-name mapping with {len(email_name_map)} entries")
+    return list(emails), email_name_map
+
+def extract_emails_from_file(file):
+    """
+    Return (emails, email_name_map) from an uploaded Excel/CSV file. The file is
+    parsed in chunks straight from its upload stream, so memory use depends on
+    the number of addresses rather than the size of the file.
+    """
+    try:
+        # Get file extension
+        filename = file.filename
+        file_ext = filename.rsplit('.', 1)[1].lower()
+        logger.debug(f"Processing file: {filename} with extension: {file_ext}")
         
-        return list(set(emails)), email_name_map  # Return emails and email-name mapping
+        # Read the spooled upload itself; pandas ignores encoding when given the FileStorage wrapper
+        stream = file.stream
+        try:
+            return collect_emails_from_chunks(iter_file_chunks(stream, file_ext))
+        except UnicodeDecodeError:
+            if file_ext != 'csv':
+                raise
+            stream.seek(0)  # Reset file pointer and retry CSV with a permissive encoding
+            return collect_emails_from_chunks(iter_file_chunks(stream, file_ext, encoding='latin1'))
     except Exception as e:
         logger.error(f"Error processing file: {str(e)}", exc_info=True)
         raise ValueError(f"Error processing file: {str(e)}")
 
-def get_dashboard_data():
+def get_sendgrid_dashboard_data():
     try:
         analytics = SendGridAnalytics()
         
@@ -514,9 +621,28 @@ def get_dashboard_data():
             'delivery_chart_data': delivery_chart_data
         }
     except Exception as e:
-        logger.error(f"Error in get_dashboard_data: {str(e)}", exc_info=True)
+        logger.error(f"Error in get_sendgrid_dashboard_data: {str(e)}", exc_info=True)
         raise
 
+def get_dashboard_data():
+    # Per-campaign / per-template engagement comes from Event Webhook aggregates (no API calls), so it
+    # is loaded on its own and stays available when the SendGrid API is down or not configured
+    event_store.ensure_started()
+    data = {
+        'global_stats': {},
+        'daily_stats': [],
+        'activity_chart_data': [],
+        'delivery_chart_data': [],
+        'sendgrid_error': None,
+        'campaign_stats': event_store.campaign_stats(),
+        'template_stats': event_store.template_stats()
+    }
+    try:
+        data.update(get_sendgrid_dashboard_data())
+    except Exception as e:
+        data['sendgrid_error'] = str(e)
+    return data
+
 @app.route('/dashboard')
 @login_required
 def dashboard():
@@ -526,7 +652,10 @@ def dashboard():
                              global_stats=data['global_stats'],
                              daily_stats=data['daily_stats'],
                              activity_chart_data=data['activity_chart_data'],
-                             delivery_chart_data=data['delivery_chart_data'])
+                             delivery_chart_data=data['delivery_chart_data'],
+                             sendgrid_error=data['sendgrid_error'],
+                             campaign_stats=data['campaign_stats'],
+                             template_stats=data['template_stats'])
     except Exception as e:
         error_msg = f'Error loading dashboard: {str(e)}'
         logger.error(error_msg, exc_info=True)
@@ -544,29 +673,97 @@ def refresh_dashboard():
         logger.error(f"Error in refresh_dashboard: {error_msg}", exc_info=True)
         return jsonify({'error': error_msg}), 500
 
+@app.route('/analytics/campaigns')
+@login_required
+def campaign_analytics_query():
+    """Cross-campaign aggregates from the batch summaries, e.g. ?by=domain&days=90"""
+    by = request.args.get('by', 'day')
+    days = request.args.get('days', type=int)
+    limit = request.args.get('limit', type=int)
+    if by not in DIMENSIONS:
+        return jsonify({'error': f"Unsupported dimension '{by}'", 'dimensions': DIMENSIONS}), 400
+    try:
+        return jsonify({'by': by, 'days': days, 'rows': campaign_analytics.aggregate(by, days=days, limit=limit)})
+    except Exception as e:
+        logger.error(f"Error in campaign analytics query: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/audience')
+@login_required
+def audience():
+    """
+    Follow-up targeting from the recipient history index, e.g.
+    ?template=email_template.html&days=14&exclude=template-3.html[&format=csv]
+    """
+    template = request.args.get('template')
+    if not template:
+        return jsonify({'error': 'template is required'}), 400
+    days = request.args.get('days', type=float)
+    exclude = request.args.getlist('exclude')
+    exclude_bounced = request.args.get('include_bounced') != '1'
+    
+    if request.args.get('format') == 'csv':
+        def generate():
+            # Streamed a few hundred rows at a time; audiences can run to millions of addresses
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(['email'])
+            for i, email in enumerate(recipient_history.iter_audience(template, days, exclude, exclude_bounced), 1):
+                writer.writerow([email])
+                if i % 500 == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+        
+        return Response(generate(), mimetype='text/csv', headers={
+            'Content-Disposition': f'attachment; filename=audience_{os.path.splitext(template)[0]}.csv'
+        })
+    
+    count = recipient_history.audience_count(template, days, exclude, exclude_bounced)
+    sample = recipient_history.audience(template, days, exclude, exclude_bounced, limit=20)
+    return jsonify({'count': count, 'sample': sample})
+
+@app.route('/webhooks/sendgrid/events', methods=['POST'])
+def sendgrid_event_webhook():
+    """Accept a batch of SendGrid events; aggregation happens in the background"""
+    payload = request.get_data(cache=False)
+    if not verify_webhook_request(payload, request.headers, request.args):
+        logger.warning("Rejected unverified SendGrid webhook request")
+        return jsonify({'error': 'Invalid webhook credentials'}), 403
+    if not payload.lstrip().startswith(b'['):
+        return jsonify({'error': 'Expected a JSON array of events'}), 400
+    
+    event_store.append(payload)
+    event_store.ensure_started()
+    return '', 204
+
 def get_batch_logs():
     """Get all batch logs from the email_logs directory"""
     try:
         # Get all log files
-        log_files = glob.glob(os.path.join('email_logs', 'email_batch_*.log'))
+        log_files = glob.glob(os.path.join(LOGS_DIR, 'email_batch_*.log'))
         batch_data = []
         
         # Define timezone
+        import pytz
         pkt_tz = pytz.timezone('Asia/Karachi')  # Pakistan Standard Time
         
         for log_file in sorted(log_files, reverse=True):  # Sort by newest first
             # Get corresponding summary file
             summary_file = log_file.replace('.log', '_summary.json')
             
-            # Read summary data if exists
+            # Read only the campaign's top-level fields, streaming the summary; the log itself is fetched
+            # when its panel is opened (batch_log). Current summaries put every field ahead of the
+            # per-recipient lists, so reading stops at the first list item. Older ones wrote the lists
+            # first; for those the items are skipped and the fields after them are still collected
             summary_data = {}
             if os.path.exists(summary_file):
-                with open(summary_file, 'r') as f:
-                    summary_data = json.load(f)
-            
-            # Read log file
-            with open(log_file, 'r') as f:
-                log_content = f.read()
+                for kind, key, value in iter_summary(summary_file):
+                    if kind == 'field':
+                        summary_data[key] = value
+                    elif 'campaign_id' in summary_data:
+                        break
             
             # Extract timestamp from filename
             timestamp_match = re.search(r'email_batch_(\d{8}_\d{6})', log_file)
@@ -587,6 +784,7 @@ def get_batch_logs():
             
             batch_data.append({
                 'batch_id': batch_id,
+                'batch_name': os.path.basename(log_file)[:-len('.log')],
                 'timestamp': formatted_time,
                 'total_emails': summary_data.get('total_emails', 0),
                 'successful_emails': summary_data.get('successful_emails', 0),
@@ -597,7 +795,7 @@ def get_batch_logs():
                 'subject': summary_data.get('subject', 'N/A'),
                 'template': summary_data.get('template', 'N/A'),
                 'processing_time': summary_data.get('processing_time', 'N/A'),
-                'log_content': log_content
+                'domains': summary_data.get('domains', {})
             })
         
         return batch_data
@@ -605,6 +803,97 @@ def get_batch_logs():
         logger.error(f"Error reading batch logs: {str(e)}", exc_info=True)
         return []
 
+def failure_filters():
+    """Failure report filters from the query string"""
+    return {
+        'failure_type': request.args.get('type') or None,
+        'domain': request.args.get('domain') or None,
+        'error_class': request.args.get('error_class') or None,
+        'query': request.args.get('q') or None
+    }
+
+@app.route('/batches/<batch_name>/log')
+@login_required
+def batch_log(batch_name):
+    """The end of a campaign's log as plain text, loaded when its Detailed Logs panel is opened"""
+    log_file = os.path.join(LOGS_DIR, f'{batch_name}.log')
+    if not BATCH_NAME_PATTERN.fullmatch(batch_name) or not os.path.exists(log_file):
+        return jsonify({'error': 'Campaign not found'}), 404
+    
+    tail_bytes = app.config['LOG_TAIL_KB'] * 1024
+    with open(log_file, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(size - tail_bytes, 0))
+        content = f.read().decode('utf-8', 'replace')
+    if size > tail_bytes:
+        # Drop the partial first line and say what was left out
+        content = f"[Showing the last {tail_bytes // 1024} KB of a {size // 1024} KB log]\n" + content.partition('\n')[2]
+    return Response(content, mimetype='text/plain')
+
+@app.route('/batches/<batch_name>/failures')
+@login_required
+def batch_failures(batch_name):
+    """Paginated, filterable list of a campaign's failed sends"""
+    try:
+        report = failure_report.page(batch_name,
+                                     page=request.args.get('page', 1, type=int),
+                                     per_page=request.args.get('per_page', 50, type=int),
+                                     **failure_filters())
+    except (OSError, ValueError) as e:
+        logger.error(f"Error loading failure report for {batch_name}: {str(e)}", exc_info=True)
+        report = None
+    if report is None:
+        flash('No failure report found for that campaign.', 'error')
+        return redirect(url_for('batch_activity'))
+    filters = {key: value for key, value in request.args.items() if key in ('type', 'domain', 'error_class', 'q') and value}
+    return render_template('failures.html', report=report, filters=filters, batch_name=batch_name)
+
+@app.route('/batches/<batch_name>/failures.csv')
+@login_required
+def batch_failures_csv(batch_name):
+    """Stream a campaign's (filtered) failed sends as CSV"""
+    if batch_summary_path(batch_name) is None:
+        return jsonify({'error': 'Campaign not found'}), 404
+    return Response(failure_report.iter_csv(batch_name, **failure_filters()), mimetype='text/csv', headers={
+        'Content-Disposition': f'attachment; filename={batch_name}_failures.csv'
+    })
+
+@app.route('/batches/<batch_name>/export.csv')
+@login_required
+def batch_export_csv(batch_name):
+    """Stream every recipient outcome of a campaign as CSV"""
+    summary_path = batch_summary_path(batch_name)
+    if summary_path is None:
+        return jsonify({'error': 'Campaign not found'}), 404
+    return Response(iter_outcomes_csv(summary_path), mimetype='text/csv', headers={
+        'Content-Disposition': f'attachment; filename={batch_name}_outcomes.csv'
+    })
+
+@app.route('/batches/<batch_name>/export.parquet')
+@login_required
+def batch_export_parquet(batch_name):
+    """Write a campaign's recipient outcomes to a temporary Parquet file and send it"""
+    summary_path = batch_summary_path(batch_name)
+    if summary_path is None:
+        return jsonify({'error': 'Campaign not found'}), 404
+    
+    import tempfile
+    from flask import send_file
+    
+    # Parquet's footer is written last, so the file is built on disk and then streamed
+    export_file = tempfile.NamedTemporaryFile(suffix='.parquet')
+    try:
+        write_parquet(summary_path, export_file.name)
+    except RuntimeError as e:
+        export_file.close()
+        flash(str(e), 'error')
+        return redirect(url_for('batch_activity'))
+    
+    response = send_file(export_file.name, mimetype='application/vnd.apache.parquet', as_attachment=True,
+                         download_name=f'{batch_name}_outcomes.parquet')
+    response.call_on_close(export_file.close)
+    return response
+
 @app.route('/batch-activity')
 @login_required
 def batch_activity():
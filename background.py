@@ -0,0 +1,101 @@
+import os
+import logging
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows has no fcntl; fall back to the in-process locks only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Campaign logs, summaries and every file-backed store live under this directory
+LOGS_DIR = 'email_logs'
+
+
+@contextmanager
+def file_lock(path, blocking=True):
+    """
+    Hold an exclusive lock on path shared by every worker process.
+    Yields True once held; with blocking=False it yields False instead of
+    waiting when another process holds the lock. Without fcntl it always
+    yields True and callers rely on their in-process lock.
+    """
+    with open(path, 'w') as lock:
+        if fcntl is None:
+            yield True
+            return
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class BackgroundWorker:
+    """
+    Periodic work done on a daemon thread in each worker process.
+
+    Subclasses implement _work(), which runs under lock_file so only one
+    process does a pass at a time, and return the number of items handled.
+    The thread runs passes every interval seconds, or sooner after wake(),
+    until a pass finds nothing to do. ensure_started() starts it again in a
+    forked child, where the parent's thread does not exist.
+    """
+
+    thread_name = 'background-worker'
+
+    def __init__(self, lock_file, interval):
+        self.lock_file = lock_file
+        self.interval = interval
+        self._pass_lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+
+    def _work(self):
+        raise NotImplementedError
+
+    def run_pass(self):
+        """Run one pass; returns _work()'s result, or None if another process holds the lock"""
+        with self._pass_lock, file_lock(self.lock_file, blocking=False) as acquired:
+            if not acquired:
+                return None
+            return self._work()
+
+    def ensure_started(self):
+        """Start the background thread for this process (again after a fork)"""
+        if self._thread is not None and self._thread_pid == os.getpid() and self._thread.is_alive():
+            return
+        self._thread_pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        """Run the next pass now instead of after the interval"""
+        self._wakeup.set()
+
+    def stop(self):
+        """Stop this process's background thread and wait for a running pass to finish"""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread_pid == os.getpid():
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopping.is_set():
+                return
+            try:
+                while self.run_pass():
+                    pass
+            except Exception as e:
+                logger.error(f"Error in {self.thread_name}: {str(e)}", exc_info=True)
@@ -1,15 +1,18 @@
 import os
-import pandas as pd
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Email, To, Content, Header
 from dotenv import load_dotenv
 import logging
 from datetime import datetime
-import json
+import time
 import uuid
+from background import LOGS_DIR
+from progress_events import progress_bus, ProgressTracker
+from domain_throttle import DomainThrottledSender, recipient_domain
+from recipient_history import recipient_history
+from retry_queue import retry_queue, is_transient_failure
+from mail_transport import get_transport
+from campaign_state import CampaignOutcomes, write_summary
 
 # Create logs directory if it doesn't exist
-LOGS_DIR = 'email_logs'
 if not os.path.exists(LOGS_DIR):
     os.makedirs(LOGS_DIR)
 
@@ -18,15 +21,23 @@ load_dotenv()
 
 class BulkEmailSender:
     def __init__(self):
-        self.sg = SendGridAPIClient(os.getenv('SENDGRID_API_KEY'))
-        self.from_email = Email(os.getenv('FROM_EMAIL', 'origination@clean-earth.org'))
+        # SendGrid HTTP API or SMTP relay, depending on MAIL_TRANSPORT
+        self.transport = get_transport()
+        self.from_email = os.getenv('FROM_EMAIL', 'origination@clean-earth.org')
         
-        # Create a new log file for this instance
+        # Create a new log file for this instance. Files are keyed by campaign id as well as
+        # time so campaigns started in the same second (e.g. by two workers) never collide
+        campaign_id = str(uuid.uuid4())  # Unique identifier for the campaign
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        self.log_file = os.path.join(LOGS_DIR, f'email_batch_{timestamp}.log')
+        self.batch_name = f'email_batch_{timestamp}_{campaign_id}'
+        self.log_file = os.path.join(LOGS_DIR, f'{self.batch_name}.log')
+        self.summary_file = self.log_file.replace('.log', '_summary.json')
+        self.retry_items = []  # (email, message) pairs queued for retry when the summary is saved
+        self.outcomes = CampaignOutcomes()  # Per-recipient results, written to the summary's 'recipients'
         
-        # Configure logging
-        self.logger = logging.getLogger(f'email_batch_{timestamp}')
+        # Configure logging. The logger is not registered with logging.getLogger(), which would keep
+        # one logger per campaign in the logging module for the life of the process
+        self.logger = logging.Logger(self.batch_name)
         self.logger.setLevel(logging.DEBUG)
         
         # File handler
@@ -46,91 +57,123 @@ class BulkEmailSender:
         self.logger.addHandler(file_handler)
         self.logger.addHandler(console_handler)
         
-        self.logger.info(f"Initialized BulkEmailSender with from_email: {self.from_email.email}")
+        self.logger.info(f"Initialized BulkEmailSender with from_email: {self.from_email} via {self.transport.name}")
         
         # Initialize batch data
         self.batch_data = {
             'timestamp': timestamp,
-            'from_email': self.from_email.email,
+            'from_email': self.from_email,
             'total_emails': 0,
             'successful_emails': 0,
             'failed_emails': 0,
-            'recipients': [],
-            'errors': [],
+            'errors': [],  # Batch-level errors; per-recipient errors are kept in self.outcomes
+            'domains': {},  # Per receiving domain: total/successful/failed
             'source': None,  # 'manual' or 'file'
             'file_name': None,  # Name of uploaded file if source is 'file'
             'subject': None,
             'template': None,
-            'campaign_id': str(uuid.uuid4()),  # Unique identifier for the campaign
+            'campaign_id': campaign_id,
             'start_time': datetime.now().isoformat(),
             'end_time': None,
             'processing_time': None
         }
 
+    def record_domain_result(self, to_email, success):
+        """
+        Count a send outcome against the recipient's domain
+        """
+        domain = recipient_domain(to_email) or 'unknown'
+        counters = self.batch_data['domains'].setdefault(domain, {'total': 0, 'successful': 0, 'failed': 0})
+        counters['total'] += 1
+        if success:
+            counters['successful'] += 1
+        else:
+            counters['failed'] += 1
+
+    def record_success(self, to_email, response_code=None, message_id=None):
+        """
+        Record a sent email
+        """
+        self.record_domain_result(to_email, True)
+        self.batch_data['successful_emails'] += 1
+        self.outcomes.add(to_email, 'success', response_code=response_code, message_id=message_id)
+
+    def record_failure(self, to_email, error, transient, retry_message=None):
+        """
+        Record a failed send. Transient failures with a retry_message are queued
+        for retry (see queue_retry()).
+        """
+        self.record_domain_result(to_email, False)
+        self.batch_data['failed_emails'] += 1
+        retry = None
+        if transient and retry_message is not None:
+            retry = 'queued'
+            self.queue_retry(to_email, retry_message)
+        self.outcomes.add(to_email, 'failed', error=error, retry=retry,
+                          failure_type='transient' if transient else 'permanent')
+
+    def queue_retry(self, to_email, message):
+        """
+        Hand a transiently failed send to the retry queue once the batch summary
+        is saved. message is the dict retry_queue.send_message() builds the email from.
+        """
+        self.retry_items.append((to_email, message))
+
     def send_email(self, to_email, subject, html_content):
         """
-        Send a single email using SendGrid
+        Send a single email through the configured mail transport
         """
-        try:
-            message = Mail(
-                from_email=self.from_email,
-                to_emails=To(to_email),
-                subject=subject,
-                html_content=Content("text/html", html_content)
-            )
-            
-            # Add headers for better deliverability
-            message.add_header(Header("X-Message-ID", f"<{to_email}-{int(pd.Timestamp.now().timestamp())}@clean-earth.org>"))
-            message.add_header(Header("List-Unsubscribe", "<mailto:unsubscribe@clean-earth.org>"))
-            message.add_header(Header("Precedence", "bulk"))
-            message.add_header(Header("X-Campaign-ID", self.batch_data['campaign_id']))
-            
+        # Headers for better deliverability
+        headers = {
+            "X-Message-ID": f"<{to_email}-{int(time.time())}@clean-earth.org>",
+            "List-Unsubscribe": "<mailto:unsubscribe@clean-earth.org>",
+            "Precedence": "bulk",
+            "X-Campaign-ID": self.batch_data['campaign_id']
+        }
+        # Custom args are echoed back on Event Webhook events for per-campaign stats
+        custom_args = {"campaign_id": self.batch_data['campaign_id']}
+        if self.batch_data['template']:
+            custom_args["template"] = self.batch_data['template']
+
+        message = {
+            'from_email': self.from_email,
+            'to': to_email,
+            'subject': subject,
+            'html': html_content,
+            'headers': headers,
+            'custom_args': custom_args,
             # Set reply-to header
-            message.reply_to = Email("david.e@clean-earth.org", "David E")
-            
-            self.logger.info(f"Sending email to {to_email} with subject: {subject}")
-            response = self.sg.send(message)
-            self.logger.info(f"Email sent successfully to {to_email}. Status code: {response.status_code}")
-            self.logger.info(f"Response headers: {response.headers}")
-            
-            # Log the full response for debugging
-            self.logger.debug(f"Full response: {response.__dict__}")
+            'reply_to': ["david.e@clean-earth.org", "David E"]
+        }
+        
+        self.logger.info(f"Sending email to {to_email} with subject: {subject}")
+        result = self.transport.send(message)
+        if result.ok:
+            self.logger.info(f"Email sent successfully to {to_email}. Status code: {result.status_code}")
+            self.logger.debug(f"Message ID: {result.message_id}")
             
             # Update batch data
-            self.batch_data['successful_emails'] += 1
-            self.batch_data['recipients'].append({
-                'email': to_email,
-                'status': 'success',
-                'timestamp': datetime.now().isoformat(),
-                'response_code': response.status_code,
-                'message_id': response.headers.get('X-Message-Id', '')
-            })
-            
+            self.record_success(to_email, result.status_code, result.message_id)
             return True
-        except Exception as e:
-            self.logger.error(f"Error sending email to {to_email}: {str(e)}", exc_info=True)
-            
-            # Update batch data
-            self.batch_data['failed_emails'] += 1
-            self.batch_data['recipients'].append({
-                'email': to_email,
-                'status': 'failed',
-                'timestamp': datetime.now().isoformat(),
-                'error': str(e)
-            })
-            self.batch_data['errors'].append({
-                'email': to_email,
-                'error': str(e),
-                'timestamp': datetime.now().isoformat()
-            })
-            
-            return False
+        
+        self.logger.error(f"Error sending email to {to_email}: {result.error}")
+        
+        # Update batch data; transient failures are retried from the template on disk
+        retry_message = None
+        if self.batch_data.get('template_path'):
+            retry_message = dict({key: value for key, value in message.items() if key != 'html'},
+                                 template_path=self.batch_data['template_path'])
+        self.record_failure(to_email, result.error, is_transient_failure(result.status_code, result.error, result.transient),
+                            retry_message)
+        return False
 
     def send_bulk_emails(self, recipients_file, subject, template_path):
         """
         Send bulk emails to recipients from a CSV file
         CSV file should have at least an 'email' column
         """
+        import pandas as pd
+
         try:
             # Read recipients from CSV
             df = pd.read_csv(recipients_file)
@@ -140,6 +183,7 @@ class BulkEmailSender:
             self.batch_data['total_emails'] = len(df)
             self.batch_data['subject'] = subject
             self.batch_data['template_path'] = template_path
+            self.batch_data['template'] = os.path.basename(template_path)
             
             # Read email template
             with open(template_path, 'r') as file:
@@ -148,13 +192,27 @@ class BulkEmailSender:
             
             # Send emails to each recipient
             success_count = 0
-            for _, row in df.iterrows():
-                email = row['email']
-                # You can customize the template with recipient-specific data here
-                html_content = template
-                
-                if self.send_email(email, subject, html_content):
+            progress = ProgressTracker(progress_bus, self.batch_data['campaign_id'], len(df),
+                                       template=self.batch_data['template'], subject=subject)
+            progress.start()
+            # One worker keeps send_email()'s batch_data updates single-threaded;
+            # domains are still interleaved and rate limited
+            recipients = df['email'].astype(str).tolist()
+            throttled_sender = DomainThrottledSender(max_workers=1)
+            # You can customize the template with recipient-specific data here
+            html_content = template
+            
+            def send_failed(to, error):
+                # send_email() raised before recording anything for this recipient
+                self.record_failure(to, str(error), False)
+                return False
+            
+            for email, sent in throttled_sender.run(recipients, lambda to: self.send_email(to, subject, html_content),
+                                                    on_error=send_failed):
+                progress.record(sent)
+                if sent:
                     success_count += 1
+            progress.finish()
             
             self.logger.info(f"Bulk email sending completed. Successfully sent: {success_count}/{len(df)}")
             
@@ -169,6 +227,8 @@ class BulkEmailSender:
                 'timestamp': datetime.now().isoformat()
             })
             self.save_batch_summary()
+        finally:
+            self.close()
 
     def save_batch_summary(self):
         """
@@ -186,12 +246,27 @@ class BulkEmailSender:
             success_rate = (self.batch_data['successful_emails'] / total) * 100
             self.batch_data['success_rate'] = f"{success_rate:.2f}%"
         
-        # Save summary to JSON file
-        summary_file = self.log_file.replace('.log', '_summary.json')
-        with open(summary_file, 'w') as f:
-            json.dump(self.batch_data, f, indent=2)
+        # Save summary to JSON file, with the per-recipient lists last so streaming
+        # readers (exports, failure reports) see the campaign fields first
+        summary_file = self.summary_file
+        fields = {key: value for key, value in self.batch_data.items() if key != 'errors'}
+        write_summary(summary_file, fields, self.outcomes, self.batch_data['errors'])
         self.logger.info(f"Batch summary saved to {summary_file}")
         
+        # Keep the per-recipient history index used for follow-up targeting up to date
+        try:
+            recipient_history.record_campaign(dict(self.batch_data, recipients=self.outcomes))
+        except Exception as e:
+            self.logger.error(f"Error updating recipient history: {str(e)}", exc_info=True)
+        
+        # Transient failures are retried in the background against this summary
+        if self.retry_items:
+            try:
+                retry_queue.enqueue(self.batch_data['campaign_id'], summary_file, self.retry_items)
+                self.retry_items = []
+            except Exception as e:
+                self.logger.error(f"Error queueing retries: {str(e)}", exc_info=True)
+        
         # Log final statistics
         self.logger.info(f"Campaign completed - ID: {self.batch_data['campaign_id']}")
         self.logger.info(f"Total emails: {total}")
@@ -201,6 +276,14 @@ class BulkEmailSender:
             self.logger.info(f"Success rate: {self.batch_data['success_rate']}")
         self.logger.info(f"Processing time: {self.batch_data['processing_time']}")
 
+    def close(self):
+        """
+        Detach and close this campaign's log handlers so long-running workers do not leak files
+        """
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+
 def main():
     # Example usage
     sender = BulkEmailSender()
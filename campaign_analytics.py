@@ -0,0 +1,219 @@
+import os
+import re
+import glob
+import pickle
+import logging
+import tempfile
+import threading
+from datetime import datetime, timedelta
+
+from background import LOGS_DIR
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE = os.path.join(LOGS_DIR, 'analytics_cache.pkl')
+
+# Dimensions that aggregate queries can group by
+DIMENSIONS = ['day', 'domain', 'template', 'source', 'error_class']
+
+# Columns stored as pandas categoricals to keep the frame compact
+CATEGORICAL_COLUMNS = ['summary_file', 'campaign_id', 'domain', 'status', 'template', 'source', 'error_class']
+
+
+def classify_error(error):
+    """Map a free-form send error to a small set of error classes"""
+    if not error:
+        return 'none'
+    text = str(error).lower()
+    match = re.match(r'smtp ([45])\d\d\b', text)
+    if match:
+        return f"smtp_{match.group(1)}xx"
+    match = re.search(r'\b([45]\d\d)\b', text)
+    if match:
+        return f"http_{match.group(1)[0]}xx"
+    if 'timed out' in text or 'timeout' in text:
+        return 'timeout'
+    if 'connection' in text or 'network' in text:
+        return 'connection'
+    if 'invalid' in text or 'does not contain a valid' in text:
+        return 'invalid_address'
+    return 'other'
+
+
+class CampaignAnalytics:
+    """
+    Columnar view of every per-recipient outcome in the batch summaries.
+
+    All email_batch_*_summary.json files are flattened into one pandas
+    DataFrame (one row per recipient send). Only summaries that are new or
+    changed since the last refresh are parsed; the frame and a file index are
+    pickled to CACHE_FILE so restarts do not re-read every summary.
+    """
+
+    def __init__(self, logs_dir=LOGS_DIR, cache_file=CACHE_FILE):
+        self.logs_dir = logs_dir
+        self.cache_file = cache_file
+        self._lock = threading.Lock()
+        self._frame = None
+        self._files = {}  # summary file name -> (mtime, size)
+
+    def _empty_frame(self):
+        import pandas as pd
+
+        frame = pd.DataFrame({column: pd.Series([], dtype='object') for column in CATEGORICAL_COLUMNS})
+        frame['timestamp'] = pd.Series([], dtype='datetime64[ns]')
+        return frame.astype({column: 'category' for column in CATEGORICAL_COLUMNS})
+
+    def _load_cache(self):
+        if not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'rb') as f:
+                cached = pickle.load(f)
+            self._frame = cached['frame']
+            self._files = cached['files']
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable analytics cache: {str(e)}")
+            self._frame = None
+            self._files = {}
+
+    def _save_cache(self):
+        # A temp file of its own per call, so workers saving at the same time never write into each other's
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.cache_file) or '.', prefix='.tmp_', suffix='.pkl')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump({'frame': self._frame, 'files': self._files}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.cache_file)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _read_summary(self, path):
+        """Return column lists for one summary file, streaming its recipients"""
+        from campaign_export import iter_summary
+
+        fields = {}
+        domains, statuses, error_classes, timestamps = [], [], [], []
+        for kind, key, value in iter_summary(path):
+            if kind == 'field':
+                fields[key] = value
+            elif key == 'recipients' and isinstance(value, dict):
+                email = str(value.get('email', ''))
+                domains.append(email.rsplit('@', 1)[-1].lower() if '@' in email else 'unknown')
+                statuses.append(value.get('status', 'unknown'))
+                error_classes.append(classify_error(value.get('error')))
+                timestamps.append(value.get('timestamp'))
+        # Older summaries write the campaign fields after the recipients, so they are filled in last
+        name = os.path.basename(path)
+        count = len(statuses)
+        start_time = fields.get('start_time')
+        return {
+            'summary_file': [name] * count,
+            'campaign_id': [fields.get('campaign_id') or name] * count,
+            'domain': domains,
+            'status': statuses,
+            'template': [fields.get('template') or 'unknown'] * count,
+            'source': [fields.get('source') or 'unknown'] * count,
+            'error_class': error_classes,
+            'timestamp': [timestamp or start_time for timestamp in timestamps]
+        }
+
+    def refresh(self):
+        """Incrementally bring the frame up to date with the summaries on disk"""
+        import pandas as pd
+        from pandas.api.types import union_categoricals
+
+        with self._lock:
+            if self._frame is None:
+                self._load_cache()
+                if self._frame is None:
+                    self._frame = self._empty_frame()
+
+            current = {}
+            for path in glob.glob(os.path.join(self.logs_dir, 'email_batch_*_summary.json')):
+                stat = os.stat(path)
+                current[os.path.basename(path)] = (stat.st_mtime, stat.st_size)
+
+            changed = [name for name, signature in current.items() if self._files.get(name) != signature]
+            removed = [name for name in self._files if name not in current]
+            if not changed and not removed:
+                return self._frame
+
+            columns = {column: [] for column in CATEGORICAL_COLUMNS + ['timestamp']}
+            for name in changed:
+                try:
+                    rows = self._read_summary(os.path.join(self.logs_dir, name))
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Skipping unreadable summary {name}: {str(e)}")
+                    continue
+                for column, values in rows.items():
+                    columns[column].extend(values)
+
+            new_rows = pd.DataFrame({column: pd.Series(values, dtype='object') for column, values in columns.items()})
+            new_rows['timestamp'] = pd.to_datetime(new_rows['timestamp'], format='ISO8601', errors='coerce')
+
+            # Merge categoricals directly so existing rows are never re-encoded
+            stale = set(changed) | set(removed)
+            frame = self._frame[~self._frame['summary_file'].isin(stale)]
+            merged = {
+                column: union_categoricals([frame[column], new_rows[column].astype('category')],
+                                           ignore_order=True)
+                for column in CATEGORICAL_COLUMNS
+            }
+            merged['timestamp'] = pd.concat([frame['timestamp'], new_rows['timestamp']], ignore_index=True)
+            self._frame = pd.DataFrame(merged)
+            self._files = current
+            self._save_cache()
+            logger.info(f"Analytics refreshed: {len(changed)} new/changed and {len(removed)} removed summaries, "
+                        f"{len(self._frame)} rows")
+            return self._frame
+
+    def aggregate(self, by='day', days=None, limit=None):
+        """
+        Totals, successes, failures and success rate grouped by one dimension.
+        days restricts the query to the last N days; error_class only counts failures.
+        """
+        if by not in DIMENSIONS:
+            raise ValueError(f"Unsupported dimension '{by}', expected one of {', '.join(DIMENSIONS)}")
+
+        frame = self.refresh()
+        if days is not None:
+            frame = frame[frame['timestamp'] >= datetime.now() - timedelta(days=days)]
+
+        if by == 'error_class':
+            frame = frame[frame['status'] != 'success']
+
+        if by == 'day':
+            keys = frame['timestamp'].dt.normalize()
+        else:
+            keys = frame[by]
+        success = (frame['status'] == 'success').astype('int64')
+
+        grouped = success.groupby(keys, observed=True).agg(['size', 'sum'])
+        grouped.columns = ['total', 'successful']
+        grouped = grouped[grouped['total'] > 0]
+        grouped['failed'] = grouped['total'] - grouped['successful']
+        grouped['success_rate'] = (grouped['successful'] / grouped['total'] * 100).round(2)
+
+        if by == 'day':
+            grouped = grouped.sort_index()
+        else:
+            grouped = grouped.sort_values('total', ascending=False)
+        if limit:
+            grouped = grouped.head(limit)
+
+        return [
+            {
+                'key': key.strftime('%Y-%m-%d') if by == 'day' else str(key),
+                'total': int(row.total),
+                'successful': int(row.successful),
+                'failed': int(row.failed),
+                'success_rate': float(row.success_rate)
+            }
+            for key, row in zip(grouped.index, grouped.itertuples(index=False))
+        ]
+
+
+# Shared engine for the process
+campaign_analytics = CampaignAnalytics()
@@ -0,0 +1,259 @@
+"""
+Streaming export of per-recipient campaign outcomes.
+
+Batch summaries can hold millions of recipients, so they are never loaded
+whole: iter_summary() walks the JSON incrementally and yields one recipient at
+a time. Rows can be streamed as CSV or written to Parquet (requires pyarrow).
+
+Usage:
+    python campaign_export.py email_batch_20240101_120000 > outcomes.csv
+    python campaign_export.py email_batch_20240101_120000 --format parquet -o outcomes.parquet
+"""
+import os
+import io
+import re
+import csv
+import sys
+import json
+import logging
+import argparse
+
+from background import LOGS_DIR
+from domain_throttle import recipient_domain
+from retry_queue import is_transient_failure
+
+logger = logging.getLogger(__name__)
+
+# Batches are addressed by their log file name without the extension
+BATCH_NAME_PATTERN = re.compile(r'email_batch_[\w-]+')
+
+EXPORT_COLUMNS = ['email', 'domain', 'status', 'failure_type', 'error', 'response_code',
+                  'message_id', 'retry', 'attempts', 'timestamp']
+READ_CHUNK_CHARS = 1024 * 1024
+CSV_FLUSH_ROWS = 1000
+PARQUET_BATCH_ROWS = 50000
+
+_NON_WHITESPACE = re.compile(r'[^ \t\r\n]')
+_decoder = json.JSONDecoder()
+
+
+def batch_summary_path(batch_name, logs_dir=LOGS_DIR):
+    """Summary file for a batch name, or None if the name is invalid or the file is missing"""
+    if not BATCH_NAME_PATTERN.fullmatch(batch_name or ''):
+        return None
+    path = os.path.join(logs_dir, f'{batch_name}_summary.json')
+    return path if os.path.exists(path) else None
+
+
+class _JSONStream:
+    """Just enough of an incremental JSON reader to walk a summary's top-level object"""
+
+    def __init__(self, f):
+        self.f = f
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = self.f.read(READ_CHUNK_CHARS)
+        if not chunk:
+            self.eof = True
+            return False
+        self.text = self.text[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Next non-whitespace character, or '' at end of file"""
+        while True:
+            match = _NON_WHITESPACE.search(self.text, self.pos)
+            if match:
+                self.pos = match.start()
+                return self.text[self.pos]
+            self.pos = len(self.text)
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"Malformed summary: expected one of {chars!r}, found {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decode the next complete JSON value, reading more of the file as needed"""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number cut off by the buffer edge (e.g. "1." of "1.5") decodes as a shorter number
+            if (isinstance(value, (int, float)) and not self.eof
+                    and (end == len(self.text) or self.text[end] in '.eE+-0123456789')
+                    and self._fill()):
+                continue
+            self.pos = end
+            return value
+
+
+def iter_summary(path):
+    """
+    Walk a batch summary without loading it whole. Yields ('field', key, value)
+    for top-level values and ('item', key, element) for each element of a
+    top-level list such as 'recipients'.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        stream = _JSONStream(f)
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            key = stream.value()
+            stream.expect(':')
+            if stream.peek() == '[':
+                stream.expect('[')
+                if stream.peek() == ']':
+                    stream.expect(']')
+                else:
+                    while True:
+                        yield 'item', key, stream.value()
+                        if stream.expect(',]') == ']':
+                            break
+            else:
+                yield 'field', key, stream.value()
+            if stream.expect(',}') == '}':
+                return
+
+
+def failure_type_of(entry):
+    """'transient' or 'permanent' for a failed recipient entry, None for successes"""
+    if entry.get('status') != 'failed':
+        return None
+    if entry.get('failure_type') in ('transient', 'permanent'):
+        return entry['failure_type']
+    # Summaries written before failures were classified
+    return 'transient' if is_transient_failure(None, entry.get('error')) else 'permanent'
+
+
+def iter_outcomes(path):
+    """Yield one export row (a tuple in EXPORT_COLUMNS order) per recipient in a summary"""
+    for kind, key, entry in iter_summary(path):
+        if kind != 'item' or key != 'recipients' or not isinstance(entry, dict):
+            continue
+        email = entry.get('email', '')
+        status = entry.get('status', 'unknown')
+        failed = status == 'failed'
+        yield (
+            email,
+            recipient_domain(email) or 'unknown',
+            status,
+            failure_type_of(entry) if failed else None,
+            entry.get('error'),
+            entry.get('response_code'),
+            entry.get('message_id'),
+            entry.get('retry'),
+            entry.get('attempts') or (1 if failed else None),
+            entry.get('timestamp')
+        )
+
+
+def iter_csv(path):
+    """Yield a summary's outcomes as CSV text: the header first, then CSV_FLUSH_ROWS rows per chunk"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    for i, row in enumerate(iter_outcomes(path), 1):
+        writer.writerow(row)  # csv writes None as an empty field
+        if i % CSV_FLUSH_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def write_parquet(path, out):
+    """
+    Write a summary's outcomes to a Parquet file (path or writable binary file)
+    in row groups of PARQUET_BATCH_ROWS. Returns the number of rows written.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export requires pyarrow (pip install pyarrow)")
+
+    schema = pa.schema([
+        ('email', pa.string()),
+        ('domain', pa.string()),
+        ('status', pa.string()),
+        ('failure_type', pa.string()),
+        ('error', pa.string()),
+        ('response_code', pa.int32()),
+        ('message_id', pa.string()),
+        ('retry', pa.string()),
+        ('attempts', pa.int32()),
+        ('timestamp', pa.timestamp('us'))
+    ])
+    string_schema = pa.schema([pa.field(name, pa.string()) if name == 'timestamp' else schema.field(name)
+                               for name in EXPORT_COLUMNS])
+
+    def to_batch(rows):
+        # Rows are transposed into columns; ISO timestamps are parsed by Arrow
+        # in one cast rather than row by row
+        columns = dict(zip(EXPORT_COLUMNS, map(list, zip(*rows))))
+        return pa.Table.from_pydict(columns, schema=string_schema).cast(schema)
+
+    total = 0
+    rows = []
+    with pq.ParquetWriter(out, schema, compression='zstd') as writer:
+        for row in iter_outcomes(path):
+            rows.append(row)
+            if len(rows) == PARQUET_BATCH_ROWS:
+                writer.write_table(to_batch(rows))
+                total += len(rows)
+                rows = []
+        if rows:
+            writer.write_table(to_batch(rows))
+            total += len(rows)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export per-recipient campaign outcomes')
+    parser.add_argument('batch', help='Batch name (e.g. email_batch_20240101_120000) or path to a summary file')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('-o', '--output', help='Output file (CSV defaults to stdout)')
+    args = parser.parse_args()
+
+    path = args.batch if os.path.isfile(args.batch) else batch_summary_path(args.batch)
+    if path is None:
+        parser.error(f"No summary found for {args.batch}")
+
+    if args.format == 'parquet':
+        if not args.output:
+            parser.error('--output is required for Parquet')
+        try:
+            rows = write_parquet(path, args.output)
+        except RuntimeError as e:
+            parser.error(str(e))
+        print(f"Wrote {rows} rows to {args.output}", file=sys.stderr)
+        return
+
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        for chunk in iter_csv(path):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
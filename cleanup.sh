@@ -1,15 +1,21 @@
 #!/bin/bash
 
 # Cleanup script for custom templates
+# Usage: ./cleanup.sh [--all]
+#   By default, evicts templates unused for CUSTOM_TEMPLATE_MAX_AGE_DAYS (default 90)
+#   and keeps at most CUSTOM_TEMPLATE_MAX_COUNT (default 200) most recently used ones.
+#   --all removes every custom template and the index.
 echo "Cleaning up custom templates directory..."
 
-# Remove all HTML files from custom_templates directory
-rm -f templates/custom_templates/*.html
-
-# Remove subjects.json if it exists
-rm -f templates/custom_templates/subjects.json
-
 # Create empty directories if they don't exist
 mkdir -p templates/custom_templates
 
-echo "Cleanup completed successfully!" 
\ No newline at end of file
+if [ "$1" == "--all" ]; then
+    python template_store.py --all
+else
+    python template_store.py \
+        --max-age-days "${CUSTOM_TEMPLATE_MAX_AGE_DAYS:-90}" \
+        --max-templates "${CUSTOM_TEMPLATE_MAX_COUNT:-200}"
+fi
+
+echo "Cleanup completed successfully!"
@@ -0,0 +1,251 @@
+import os
+import time
+import heapq
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+
+def _positive_env(name, default, cast):
+    value = cast(os.getenv(name, default))
+    if value <= 0:
+        logger.warning(f"{name} must be greater than 0; using {default}")
+        return cast(default)
+    return value
+
+
+# Defaults applied to every receiving domain (sends per second, concurrent sends)
+DEFAULT_DOMAIN_RATE = _positive_env('DOMAIN_RATE_LIMIT', 20, float)
+DEFAULT_DOMAIN_CONCURRENCY = _positive_env('DOMAIN_CONCURRENCY', 4, int)
+# While a domain is at its concurrency limit because of another sender, check again this often (seconds)
+CONCURRENCY_POLL_INTERVAL = 0.05
+
+
+def validate_limits(rate, concurrency):
+    """Raise ValueError unless rate (sends per second) and concurrency are both greater than 0"""
+    if not rate > 0:
+        raise ValueError(f"Domain rate must be greater than 0, got {rate}")
+    if concurrency < 1:
+        raise ValueError(f"Domain concurrency must be at least 1, got {concurrency}")
+
+
+def parse_domain_limits(value):
+    """
+    Parse per-domain overrides of the form "gmail.com=5/2,outlook.com=5/2"
+    (rate per second / max concurrent sends) into {domain: (rate, concurrency)}.
+    Malformed entries and limits of 0 or less are ignored with a warning.
+    """
+    limits = {}
+    for item in (value or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            domain, spec = item.split('=', 1)
+            rate, _, concurrency = spec.partition('/')
+            rate = float(rate)
+            concurrency = int(concurrency) if concurrency else DEFAULT_DOMAIN_CONCURRENCY
+            validate_limits(rate, concurrency)
+            limits[domain.strip().lower()] = (rate, concurrency)
+        except ValueError as e:
+            logger.warning(f"Ignoring malformed domain limit {item}: {str(e)}")
+    return limits
+
+
+DOMAIN_LIMITS = parse_domain_limits(os.getenv('DOMAIN_LIMITS'))
+
+
+def recipient_domain(email):
+    return email.rsplit('@', 1)[-1].strip().lower() if '@' in email else ''
+
+
+def interleave_by_domain(recipients):
+    """
+    Order recipients so each domain is spread evenly over the whole list.
+
+    Recipient i of a domain with n recipients gets position (i + 0.5) / n, so a
+    domain holding 60% of the list appears at regular intervals rather than in
+    one long run, and small domains are not all exhausted up front.
+    """
+    groups = {}
+    for email in recipients:
+        groups.setdefault(recipient_domain(email), []).append(email)
+    keyed = []
+    for domain_index, members in enumerate(groups.values()):
+        count = len(members)
+        for i, email in enumerate(members):
+            keyed.append(((i + 0.5) / count, domain_index, email))
+    keyed.sort()
+    return [email for _, _, email in keyed]
+
+
+class TokenBucket:
+    """Simple token bucket; not thread-safe, DomainLimiter guards it"""
+
+    def __init__(self, rate):
+        if not rate > 0:
+            raise ValueError(f"Token bucket rate must be greater than 0, got {rate}")
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def try_acquire(self):
+        """Take a token and return 0, or return the seconds until one is available"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def idle(self, now):
+        """True once the bucket has refilled completely, i.e. it is no different from a new one"""
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class DomainLimiter:
+    """
+    Per-domain token buckets and in-flight counts shared by every
+    DomainThrottledSender in the process, so concurrent campaigns and the
+    retry worker together stay within each domain's rate and concurrency.
+    """
+
+    MAX_IDLE_BUCKETS = 1024
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._active = {}
+
+    def try_acquire(self, domain, rate, concurrency):
+        """
+        Reserve a send slot for domain. Returns 0 when reserved (release() it
+        afterwards), the seconds until the next token, or None while the domain
+        is at its concurrency limit.
+        """
+        with self._lock:
+            if self._active.get(domain, 0) >= concurrency:
+                return None
+            bucket = self._buckets.get(domain)
+            if bucket is None or bucket.rate != rate:
+                if len(self._buckets) >= self.MAX_IDLE_BUCKETS:
+                    self._sweep()
+                bucket = self._buckets[domain] = TokenBucket(rate)
+            token_wait = bucket.try_acquire()
+            if token_wait:
+                return token_wait
+            self._active[domain] = self._active.get(domain, 0) + 1
+            return 0
+
+    def release(self, domain):
+        with self._lock:
+            self._active[domain] -= 1
+            if not self._active[domain]:
+                del self._active[domain]
+
+    def _sweep(self):
+        # Full buckets of domains with nothing in flight carry no state worth keeping
+        now = time.monotonic()
+        for domain in [domain for domain, bucket in self._buckets.items()
+                       if domain not in self._active and bucket.idle(now)]:
+            del self._buckets[domain]
+
+
+# Shared limits for the process
+domain_limiter = DomainLimiter()
+
+
+class DomainThrottledSender:
+    """
+    Runs a send function over recipients with per-domain rate and concurrency
+    limits, interleaving domains so the overall rate stays high.
+
+    The dispatcher always submits the pending recipient with the lowest
+    interleave position among domains that currently have capacity, so a
+    throttled domain never stalls the others.
+    """
+
+    def __init__(self, max_workers=8, default_rate=DEFAULT_DOMAIN_RATE,
+                 default_concurrency=DEFAULT_DOMAIN_CONCURRENCY, domain_limits=None, limiter=None):
+        if max_workers < 1:
+            raise ValueError(f"max_workers must be at least 1, got {max_workers}")
+        validate_limits(default_rate, default_concurrency)
+        self.domain_limits = DOMAIN_LIMITS if domain_limits is None else domain_limits
+        for rate, concurrency in self.domain_limits.values():
+            validate_limits(rate, concurrency)
+        self.max_workers = max_workers
+        self.default_rate = default_rate
+        self.default_concurrency = default_concurrency
+        self.limiter = domain_limiter if limiter is None else limiter
+
+    def _limits(self, domain):
+        return self.domain_limits.get(domain, (self.default_rate, self.default_concurrency))
+
+    def run(self, recipients, send_fn, on_error=None):
+        """
+        Call send_fn(recipient) for every recipient from a worker pool and
+        yield (recipient, result) pairs in completion order.
+
+        If send_fn raises, the error is logged and on_error(recipient, error)
+        supplies the result, so one bad recipient never ends the run. Without
+        on_error the exception propagates.
+        """
+        queues = {}
+        for position, email in enumerate(interleave_by_domain(recipients)):
+            queues.setdefault(recipient_domain(email), deque()).append((position, email))
+
+        # Heap of (position of the domain's next recipient, domain)
+        ready = [(queue[0][0], domain) for domain, queue in queues.items()]
+        heapq.heapify(ready)
+        in_flight = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            try:
+                while ready or in_flight:
+                    blocked = []
+                    next_wait = None
+                    while ready and len(in_flight) < self.max_workers:
+                        position, domain = heapq.heappop(ready)
+                        rate, concurrency = self._limits(domain)
+                        slot_wait = self.limiter.try_acquire(domain, rate, concurrency)
+                        if slot_wait != 0:
+                            blocked.append((position, domain))
+                            if slot_wait is None:
+                                # At the concurrency limit; if the sends holding it are not ours, nothing
+                                # in this run will signal when they finish
+                                slot_wait = CONCURRENCY_POLL_INTERVAL
+                            next_wait = slot_wait if next_wait is None else min(next_wait, slot_wait)
+                            continue
+                        _, email = queues[domain].popleft()
+                        in_flight[pool.submit(send_fn, email)] = (email, domain)
+                        if queues[domain]:
+                            heapq.heappush(ready, (queues[domain][0][0], domain))
+                    for item in blocked:
+                        heapq.heappush(ready, item)
+
+                    if not in_flight:
+                        # Every pending domain is limited; sleep until a slot frees up
+                        time.sleep(next_wait or 0.01)
+                        continue
+
+                    done, _ = wait(in_flight, timeout=next_wait, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        email, domain = in_flight.pop(future)
+                        self.limiter.release(domain)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            if on_error is None:
+                                raise
+                            logger.error(f"Sending to {email} raised: {str(e)}", exc_info=True)
+                            result = on_error(email, e)
+                        yield email, result
+            finally:
+                # Slots of sends still running when the run stops early are returned as they finish
+                for future, (_, domain) in in_flight.items():
+                    future.add_done_callback(lambda _, domain=domain: self.limiter.release(domain))
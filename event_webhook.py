@@ -0,0 +1,231 @@
+import os
+import hmac
+import json
+import logging
+import threading
+from datetime import datetime
+
+from background import LOGS_DIR, BackgroundWorker
+from template_store import atomic_write_json
+from recipient_history import recipient_history
+
+logger = logging.getLogger(__name__)
+
+EVENTS_DIR = os.path.join(LOGS_DIR, 'events')
+
+# SendGrid event types we keep counters for; anything else is counted as 'other'
+EVENT_TYPES = ['processed', 'delivered', 'open', 'click', 'bounce', 'dropped',
+               'deferred', 'spamreport', 'unsubscribe', 'group_unsubscribe']
+
+# Events after which an address should not receive follow-ups
+SUPPRESSING_EVENTS = {'bounce', 'dropped', 'spamreport'}
+
+
+def verify_webhook_request(payload, headers, args):
+    """
+    Check an Event Webhook POST against the configured credentials.
+
+    If SENDGRID_WEBHOOK_PUBLIC_KEY is set the signed-webhook ECDSA signature is
+    verified; if SENDGRID_WEBHOOK_TOKEN is set the ?token= query parameter must
+    match. With neither configured every request is rejected: events drive
+    the dashboard and suppress addresses, so they are never taken on trust.
+    """
+    token = os.getenv('SENDGRID_WEBHOOK_TOKEN')
+    public_key = os.getenv('SENDGRID_WEBHOOK_PUBLIC_KEY')
+    if not token and not public_key:
+        logger.warning("SendGrid webhook request refused: set SENDGRID_WEBHOOK_TOKEN or SENDGRID_WEBHOOK_PUBLIC_KEY")
+        return False
+    if token and not hmac.compare_digest(args.get('token', '').encode(), token.encode()):
+        return False
+
+    if public_key:
+        from sendgrid.helpers.eventwebhook import EventWebhook, EventWebhookHeader
+
+        signature = headers.get(EventWebhookHeader.SIGNATURE)
+        timestamp = headers.get(EventWebhookHeader.TIMESTAMP)
+        if not signature or not timestamp:
+            return False
+        try:
+            return EventWebhook(public_key).verify_signature(payload.decode('utf-8'), signature, timestamp)
+        except Exception as e:
+            logger.warning(f"Webhook signature verification failed: {str(e)}")
+            return False
+    return True
+
+
+def _empty_counts():
+    counts = {event_type: 0 for event_type in EVENT_TYPES}
+    counts['other'] = 0
+    return counts
+
+
+def _with_rates(counts):
+    """Add open/click/bounce rates (percent of delivered) to a counts dict"""
+    stats = dict(counts)
+    delivered = counts.get('delivered', 0)
+    for name, event_type in [('open_rate', 'open'), ('click_rate', 'click'), ('bounce_rate', 'bounce')]:
+        stats[name] = (counts.get(event_type, 0) / delivered) * 100 if delivered > 0 else 0
+    return stats
+
+
+class EventStore(BackgroundWorker):
+    """
+    Append-only store for SendGrid Event Webhook batches.
+
+    The request path only appends the raw POST body as one line of a daily
+    NDJSON segment. A background thread later reads new lines from the last
+    checkpointed offset and folds them into per-campaign and per-template
+    counters, which are persisted atomically in aggregates.json. Aggregation is
+    guarded by a file lock so several workers can share one events directory.
+    """
+
+    thread_name = 'event-aggregator'
+
+    def __init__(self, events_dir=EVENTS_DIR, interval=2.0, history=recipient_history):
+        super().__init__(os.path.join(events_dir, '.aggregate.lock'), interval)
+        self.events_dir = events_dir
+        self.history = history
+        self.state_file = os.path.join(events_dir, 'aggregates.json')
+        self._append_lock = threading.Lock()
+        self._fd = None
+        self._fd_path = None
+        self._fd_pid = None
+        if not os.path.exists(events_dir):
+            os.makedirs(events_dir)
+
+    def _segment_path(self):
+        return os.path.join(self.events_dir, f"events_{datetime.now().strftime('%Y%m%d')}.ndjson")
+
+    def append(self, payload):
+        """Append one raw JSON batch; this is the only work done per webhook request"""
+        # JSON strings cannot contain raw newlines, so stripping them keeps one batch per line
+        line = payload.replace(b'\r', b'').replace(b'\n', b'') + b'\n'
+        path = self._segment_path()
+        with self._append_lock:
+            if self._fd is None or self._fd_path != path or self._fd_pid != os.getpid():
+                if self._fd is not None and self._fd_pid == os.getpid():
+                    os.close(self._fd)
+                self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+                self._fd_path = path
+                self._fd_pid = os.getpid()
+            os.write(self._fd, line)
+        self.wake()
+
+    def _load_state(self):
+        if not os.path.exists(self.state_file):
+            return {'offsets': {}, 'campaigns': {}, 'templates': {}, 'updated_at': None}
+        with open(self.state_file, 'r') as f:
+            return json.load(f)
+
+    def aggregate(self):
+        """
+        Fold events appended since the last checkpoint into the aggregates.
+        Returns the number of events processed, or None if another worker holds the lock.
+        """
+        return self.run_pass()
+
+    def _work(self):
+        state = self._load_state()
+        offsets = state['offsets']
+        campaigns = state['campaigns']
+        templates = state['templates']
+        processed = 0
+        advanced = False
+        suppressed = []
+
+        segments = sorted(name for name in os.listdir(self.events_dir) if name.endswith('.ndjson'))
+        for name in segments:
+            path = os.path.join(self.events_dir, name)
+            offset = offsets.get(name, 0)
+            if os.path.getsize(path) <= offset:
+                continue
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break  # Partially written batch; pick it up next round
+                    offset += len(line)
+                    try:
+                        events = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Skipping malformed webhook batch in {name} at offset {offset - len(line)}")
+                        continue
+                    if isinstance(events, dict):
+                        events = [events]
+                    if not isinstance(events, list):
+                        continue
+                    for event in events:
+                        self._apply(event, campaigns, templates)
+                        if isinstance(event, dict) and event.get('event') in SUPPRESSING_EVENTS and event.get('email'):
+                            suppressed.append(event['email'])
+                        processed += 1
+            offsets[name] = offset
+            advanced = True
+
+        if suppressed:
+            self.history.mark_bounced(suppressed)
+        if advanced:
+            state['updated_at'] = datetime.now().isoformat()
+            atomic_write_json(self.state_file, state, indent=None)
+            logger.info(f"Aggregated {processed} webhook events")
+        return processed
+
+    @staticmethod
+    def _apply(event, campaigns, templates):
+        if not isinstance(event, dict):
+            return
+        event_type = event.get('event')
+        if event_type not in EVENT_TYPES:
+            event_type = 'other'
+        campaign_id = event.get('campaign_id') or 'unknown'
+
+        campaign = campaigns.get(campaign_id)
+        if campaign is None:
+            campaign = campaigns[campaign_id] = {'template': None, 'counts': _empty_counts(), 'last_event': None}
+        if event.get('template'):
+            campaign['template'] = event['template']
+        campaign['counts'][event_type] += 1
+        timestamp = event.get('timestamp')
+        if isinstance(timestamp, (int, float)) and (campaign['last_event'] is None or timestamp > campaign['last_event']):
+            campaign['last_event'] = timestamp
+
+        template = campaign['template'] or 'unknown'
+        if template not in templates:
+            templates[template] = _empty_counts()
+        templates[template][event_type] += 1
+
+    def campaign_stats(self, limit=20):
+        """Per-campaign counters and rates, most recently active first"""
+        try:
+            state = self._load_state()
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read webhook aggregates: {str(e)}")
+            return []
+        campaigns = sorted(state['campaigns'].items(), key=lambda item: item[1]['last_event'] or 0, reverse=True)
+        rows = []
+        for campaign_id, campaign in campaigns[:limit]:
+            row = _with_rates(campaign['counts'])
+            row['campaign_id'] = campaign_id
+            row['template'] = campaign['template'] or 'unknown'
+            row['last_event'] = (datetime.fromtimestamp(campaign['last_event']).strftime('%Y-%m-%d %H:%M:%S')
+                                 if campaign['last_event'] else 'N/A')
+            rows.append(row)
+        return rows
+
+    def template_stats(self):
+        """Per-template counters and rates"""
+        try:
+            state = self._load_state()
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read webhook aggregates: {str(e)}")
+            return []
+        rows = []
+        for template, counts in sorted(state['templates'].items()):
+            row = _with_rates(counts)
+            row['template'] = template
+            rows.append(row)
+        return rows
+
+
+# Shared store for the process
+event_store = EventStore()
@@ -0,0 +1,147 @@
+import os
+import io
+import csv
+import logging
+import threading
+from collections import OrderedDict
+
+from background import LOGS_DIR
+from campaign_analytics import classify_error
+from campaign_export import batch_summary_path, failure_type_of, iter_summary
+from domain_throttle import recipient_domain
+
+logger = logging.getLogger(__name__)
+
+CAMPAIGN_FIELDS = ['campaign_id', 'subject', 'template', 'total_emails', 'successful_emails',
+                   'failed_emails', 'success_rate', 'start_time', 'end_time']
+CSV_COLUMNS = ['email', 'domain', 'failure_type', 'error_class', 'error', 'retry', 'attempts', 'timestamp']
+MAX_PER_PAGE = 200
+
+
+class FailureReport:
+    """
+    Per-campaign view of failed sends, read from the batch summary on the server.
+
+    The failed entries of a summary are extracted once and cached until the
+    file changes (the retry worker rewrites summaries as retries finish), so
+    paging and filtering do not re-read large summaries on every request.
+    """
+
+    def __init__(self, logs_dir=LOGS_DIR, cache_size=8):
+        self.logs_dir = logs_dir
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # path -> (signature, campaign info, failures)
+        self._lock = threading.Lock()
+
+    def load(self, batch_name):
+        """Return (campaign info, failure rows) for a batch, or None if it does not exist"""
+        path = batch_summary_path(batch_name, self.logs_dir)
+        if path is None:
+            return None
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._cache.get(path)
+            if cached and cached[0] == signature:
+                self._cache.move_to_end(path)
+                return cached[1], cached[2]
+
+        # Only the failed entries are kept while walking the summary
+        campaign = dict.fromkeys(CAMPAIGN_FIELDS)
+        failures = []
+        for kind, key, value in iter_summary(path):
+            if kind == 'field' and key in campaign:
+                campaign[key] = value
+            elif kind == 'item' and key == 'recipients' and value.get('status') == 'failed':
+                failures.append(self._row(value))
+        campaign['batch_name'] = batch_name
+
+        with self._lock:
+            self._cache[path] = (signature, campaign, failures)
+            self._cache.move_to_end(path)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return campaign, failures
+
+    @staticmethod
+    def _row(entry):
+        email = entry.get('email', '')
+        error = entry.get('error') or ''
+        return {
+            'email': email,
+            'domain': recipient_domain(email) or 'unknown',
+            'failure_type': failure_type_of(entry),
+            'error_class': classify_error(error),
+            'error': error,
+            'retry': entry.get('retry') or '',
+            'attempts': entry.get('attempts') or 1,
+            'timestamp': entry.get('timestamp') or ''
+        }
+
+    @staticmethod
+    def filter(failures, failure_type=None, domain=None, error_class=None, query=None):
+        """Rows matching every given filter; query is a case-insensitive match on address or error"""
+        query = (query or '').strip().lower()
+        for row in failures:
+            if failure_type and row['failure_type'] != failure_type:
+                continue
+            if domain and row['domain'] != domain:
+                continue
+            if error_class and row['error_class'] != error_class:
+                continue
+            if query and query not in row['email'].lower() and query not in row['error'].lower():
+                continue
+            yield row
+
+    def page(self, batch_name, page=1, per_page=50, **filters):
+        """One page of filtered failures plus counts for the filter controls"""
+        loaded = self.load(batch_name)
+        if loaded is None:
+            return None
+        campaign, failures = loaded
+        per_page = max(1, min(per_page, MAX_PER_PAGE))
+        matching = list(self.filter(failures, **filters))
+        pages = max(1, -(-len(matching) // per_page))
+        page = max(1, min(page, pages))
+
+        counts = {'total': len(failures)}
+        domains = {}
+        error_classes = {}
+        for row in failures:
+            counts[row['failure_type']] = counts.get(row['failure_type'], 0) + 1
+            if row['retry']:
+                counts[f"retry_{row['retry']}"] = counts.get(f"retry_{row['retry']}", 0) + 1
+            domains[row['domain']] = domains.get(row['domain'], 0) + 1
+            error_classes[row['error_class']] = error_classes.get(row['error_class'], 0) + 1
+
+        return {
+            'campaign': campaign,
+            'rows': matching[(page - 1) * per_page:page * per_page],
+            'matching': len(matching),
+            'page': page,
+            'pages': pages,
+            'per_page': per_page,
+            'counts': counts,
+            'domains': sorted(domains.items(), key=lambda item: item[1], reverse=True)[:50],
+            'error_classes': sorted(error_classes.items(), key=lambda item: item[1], reverse=True)
+        }
+
+    def iter_csv(self, batch_name, **filters):
+        """Yield the filtered failures as CSV text, a few hundred rows per chunk"""
+        loaded = self.load(batch_name)
+        if loaded is None:
+            return
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(CSV_COLUMNS)
+        for i, row in enumerate(self.filter(loaded[1], **filters), 1):
+            writer.writerow([row[column] for column in CSV_COLUMNS])
+            if i % 500 == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+
+# Shared report reader for the process
+failure_report = FailureReport()
@@ -0,0 +1,439 @@
+"""
+Pluggable mail transports used by every send loop.
+
+A message is a plain dict:
+    from_email, from_name, to, subject, html,
+    and optionally headers, custom_args and reply_to ([email, name]).
+
+Transport.send(message) returns a SendResult(status_code, error, message_id,
+transient); error is None when the message was accepted. transient is True
+or False when the transport knows whether a failure is worth retrying (a
+network error, an SMTP 4xx reply) and None when only the status code or error
+text can tell (retry_queue.is_transient_failure decides then).
+
+MAIL_TRANSPORT selects the backend for the process:
+    sendgrid  SendGrid v3 HTTP API (default)
+    smtp      Any SMTP relay (SendGrid's smtp.sendgrid.net or your own MTA)
+              over a pool of persistent, authenticated connections that
+              pipeline many messages per round trip
+"""
+import os
+import re
+import json
+import queue
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
+from email.header import Header
+from email.mime.text import MIMEText
+from email.policy import compat32
+from email.utils import formataddr, formatdate, make_msgid
+
+logger = logging.getLogger(__name__)
+
+MAIL_TRANSPORT = os.getenv('MAIL_TRANSPORT', 'sendgrid').lower()
+
+SMTP_HOST = os.getenv('SMTP_HOST', 'smtp.sendgrid.net')
+SMTP_PORT = int(os.getenv('SMTP_PORT', 587))
+SMTP_USERNAME = os.getenv('SMTP_USERNAME', 'apikey')
+SMTP_PASSWORD = os.getenv('SMTP_PASSWORD', os.getenv('SENDGRID_API_KEY', ''))
+SMTP_SECURITY = os.getenv('SMTP_SECURITY', 'starttls').lower()   # starttls, ssl or none
+SMTP_POOL_SIZE = int(os.getenv('SMTP_POOL_SIZE', 4))             # Open connections per process
+SMTP_PIPELINE_DEPTH = int(os.getenv('SMTP_PIPELINE_DEPTH', 20))  # Messages pipelined per round on a connection
+SMTP_TIMEOUT = float(os.getenv('SMTP_TIMEOUT', 30))
+SMTP_IDLE_TIMEOUT = float(os.getenv('SMTP_IDLE_TIMEOUT', 60))    # Close connections unused for this long
+
+SMTP_POLICY = compat32.clone(linesep='\r\n')
+
+
+class SendResult(namedtuple('SendResult', ['status_code', 'error', 'message_id', 'transient'], defaults=(None,))):
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class Transport:
+    """Interface the send loops call; implementations must be safe to use from several threads"""
+
+    name = None
+
+    def send(self, message):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SendGridTransport(Transport):
+    """SendGrid v3 Mail Send over HTTPS, one request per message"""
+
+    name = 'sendgrid'
+
+    def __init__(self, api_key=None):
+        # SendGrid SDK is imported here rather than at module load to keep app startup fast
+        from sendgrid import SendGridAPIClient
+        self.client = SendGridAPIClient(api_key or os.getenv('SENDGRID_API_KEY'))
+
+    def send(self, message):
+        import socket
+        import http.client
+        import urllib.error
+        from sendgrid.helpers.mail import Mail, Email, To, Content, Header, CustomArg
+
+        try:
+            mail = Mail(Email(message['from_email'], message.get('from_name')), To(message['to']),
+                        message['subject'], Content("text/html", message['html']))
+            for key, value in (message.get('headers') or {}).items():
+                mail.add_header(Header(key, value))
+            # Custom args come back on every Event Webhook event for per-campaign stats
+            for key, value in (message.get('custom_args') or {}).items():
+                mail.add_custom_arg(CustomArg(key, value))
+            if message.get('reply_to'):
+                mail.reply_to = Email(*message['reply_to'])
+
+            response = self.client.send(mail)
+            return SendResult(response.status_code, None, response.headers.get('X-Message-Id', ''))
+        except Exception as e:
+            status_code = getattr(e, 'status_code', None)
+            if status_code:
+                return SendResult(status_code, str(e), None)
+            # No response at all: DNS failures, refused or reset connections, TLS errors, timeouts
+            # and truncated responses are worth retrying; anything else (a bad address) is not
+            transient = isinstance(e, (urllib.error.URLError, socket.timeout, http.client.HTTPException, OSError))
+            return SendResult(None, str(e), None, transient)
+
+
+def smtp_error(code, text):
+    """Error text for a rejected SMTP command; retry_queue treats 4xx as temporary, 5xx as permanent"""
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', 'replace')
+    return f"SMTP {code}: {text}"
+
+
+def _header(value):
+    return value if value.isascii() else Header(value, 'utf-8')
+
+
+def build_mime(message):
+    """Render a message dict to (envelope sender, recipient, RFC 5322 bytes, Message-ID)"""
+    # The legacy MIMEText API is used because it renders several times faster than EmailMessage
+    mime = MIMEText(message['html'], 'html', 'utf-8')
+    mime['From'] = formataddr((message.get('from_name') or '', message['from_email']))
+    mime['To'] = message['to']
+    mime['Subject'] = _header(message['subject'])
+    mime['Date'] = formatdate(localtime=True)
+    message_id = make_msgid(domain=message['from_email'].rpartition('@')[2] or None)
+    mime['Message-ID'] = message_id
+    if message.get('reply_to'):
+        email, name = (list(message['reply_to']) + [None])[:2]
+        mime['Reply-To'] = formataddr((name or '', email))
+    for key, value in (message.get('headers') or {}).items():
+        if key.lower() != 'message-id':
+            mime[key] = _header(str(value))
+    if message.get('custom_args'):
+        # SendGrid's SMTP relay reads custom args (echoed on webhook events) from X-SMTPAPI
+        mime['X-SMTPAPI'] = json.dumps({'unique_args': message['custom_args']})
+    return message['from_email'], message['to'], mime.as_bytes(policy=SMTP_POLICY), message_id
+
+
+class _SMTPConnection:
+    """
+    One persistent, authenticated SMTP session.
+
+    When the server advertises PIPELINING (RFC 2920), MAIL FROM, RCPT TO and
+    DATA go out in one write, and each message body is written together with
+    the next message's commands. A message then costs one round trip instead
+    of four. If the server also supports CHUNKING (RFC 3030), each body is
+    sent with BDAT, which needs no 354 go-ahead. The whole batch then goes out
+    in one write and all replies are read back together. Servers without
+    PIPELINING get plain sendmail() on the same session.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.smtp = None
+        self.pipelining = False
+        self.chunking = False
+        self.replied = False  # Whether the server has answered anything in the current batch
+
+    def open(self):
+        import ssl
+        import smtplib
+
+        t = self.transport
+        if t.security == 'ssl':
+            smtp = smtplib.SMTP_SSL(t.host, t.port, timeout=t.timeout, context=ssl.create_default_context())
+        else:
+            smtp = smtplib.SMTP(t.host, t.port, timeout=t.timeout)
+        try:
+            smtp.ehlo()
+            if t.security == 'starttls':
+                smtp.starttls(context=ssl.create_default_context())
+                smtp.ehlo()
+            if t.username:
+                smtp.login(t.username, t.password)
+        except Exception:
+            smtp.close()
+            raise
+        self.smtp = smtp
+        self.pipelining = smtp.has_extn('pipelining')
+        self.chunking = self.pipelining and smtp.has_extn('chunking')
+        logger.info(f"Opened SMTP connection to {t.host}:{t.port} "
+                    f"(pipelining: {self.pipelining}, chunking: {self.chunking})")
+
+    def close(self):
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except Exception:
+            self.smtp.close()
+        self.smtp = None
+
+    def send_batch(self, batch):
+        """
+        Send (sender, recipient, data) items over this session and return
+        (reply code, error) for each. If the session turns out to be dead
+        before the server has replied to anything, it is reopened once. After
+        that, items left unanswered by a lost connection are reported as
+        connection errors so they can be retried.
+        """
+        import smtplib
+
+        results = [None] * len(batch)
+        for attempt in range(2):
+            if self.smtp is None:
+                self.open()
+            try:
+                if self.chunking:
+                    self._send_chunked(batch, results)
+                elif self.pipelining:
+                    self._send_pipelined(batch, results)
+                else:
+                    self._send_sequential(batch, results)
+                return results
+            except (smtplib.SMTPServerDisconnected, OSError) as e:
+                self.smtp.close()
+                self.smtp = None
+                if attempt == 0 and results[0] is None and not self.replied:
+                    logger.info(f"SMTP connection was closed ({str(e) or type(e).__name__}), reconnecting")
+                    continue
+                return [result or (None, f"SMTP connection lost: {str(e) or type(e).__name__}")
+                        for result in results]
+
+    def _reply(self):
+        code, text = self.smtp.getreply()
+        if code == -1:
+            import smtplib
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        self.replied = True
+        return code, text
+
+    @staticmethod
+    def _commands(item):
+        sender, recipient, _ = item
+        return f"MAIL FROM:<{sender}>\r\nRCPT TO:<{recipient}>\r\nDATA\r\n".encode('ascii')
+
+    def _send_chunked(self, batch, results):
+        # RSET first so a transaction refused earlier in the batch cannot affect the next one
+        self.replied = False
+        self.smtp.send(b''.join(
+            b'RSET\r\n' + self._commands(item)[:-len(b'DATA\r\n')] + b'BDAT %d LAST\r\n' % len(item[2]) + item[2]
+            for item in batch
+        ))
+        for i in range(len(batch)):
+            replies = [self._reply() for _ in range(4)]  # RSET, MAIL, RCPT, BDAT
+            code, text = next(((code, text) for code, text in replies[1:] if not 200 <= code < 300), replies[3])
+            results[i] = (code, None if 200 <= code < 300 else smtp_error(code, text))
+
+    def _send_pipelined(self, batch, results):
+        self.replied = False
+        self.smtp.send(self._commands(batch[0]))
+        for i, item in enumerate(batch):
+            following = self._commands(batch[i + 1]) if i + 1 < len(batch) else b''
+            replies = [self._reply() for _ in range(3)]  # MAIL, RCPT, DATA
+            rejected = next(((code, text) for code, text in replies[:2] if not 200 <= code < 300), None)
+            if replies[2][0] == 354 and rejected is None:
+                self.smtp.send(_dot_stuff(item[2]) + following)
+                code, text = self._reply()
+                results[i] = (code, None if 200 <= code < 300 else smtp_error(code, text))
+                continue
+            if replies[2][0] == 354:
+                # The server accepted DATA even though the recipient was refused; end it empty
+                self.smtp.send(b'.\r\n')
+                self._reply()
+            code, text = rejected or replies[2]
+            results[i] = (code, smtp_error(code, text))
+            # Start the next transaction from a clean state
+            self.smtp.send(b'RSET\r\n' + following)
+            self._reply()
+
+    def _send_sequential(self, batch, results):
+        import smtplib
+
+        self.replied = False
+        for i, (sender, recipient, data) in enumerate(batch):
+            try:
+                self.smtp.sendmail(sender, [recipient], data)
+                self.replied = True
+                results[i] = (250, None)
+            except smtplib.SMTPRecipientsRefused as e:
+                code, text = e.recipients.get(recipient, (550, b'Recipient refused'))
+                results[i] = (code, smtp_error(code, text))
+            except (smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                results[i] = (e.smtp_code, smtp_error(e.smtp_code, e.smtp_error))
+            if results[i][1] is not None:
+                self.replied = True
+                self.smtp.rset()
+
+
+def _dot_stuff(data):
+    """Escape leading dots and terminate a message for the DATA phase"""
+    data = re.sub(rb'(?m)^\.', b'..', data)
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+    return data + b'.\r\n'
+
+
+class SMTPTransport(Transport):
+    """
+    SMTP relay transport backed by a pool of persistent connections.
+
+    send() hands the message to a pool of SMTP_POOL_SIZE connection threads
+    and waits for its reply. Each thread takes whatever messages are waiting,
+    up to SMTP_PIPELINE_DEPTH, and pipelines them over its open session. The
+    more sends are in flight (SEND_WORKERS), the more messages share each
+    round trip. Connections are opened on first use, closed after
+    SMTP_IDLE_TIMEOUT seconds without traffic and reopened after a fork.
+    """
+
+    name = 'smtp'
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, username=SMTP_USERNAME, password=SMTP_PASSWORD,
+                 security=SMTP_SECURITY, pool_size=SMTP_POOL_SIZE, pipeline_depth=SMTP_PIPELINE_DEPTH,
+                 timeout=SMTP_TIMEOUT, idle_timeout=SMTP_IDLE_TIMEOUT):
+        if security not in ('starttls', 'ssl', 'none'):
+            raise ValueError(f"Unknown SMTP_SECURITY: {security}")
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.security = security
+        self.pool_size = max(1, pool_size)
+        self.pipeline_depth = max(1, pipeline_depth)
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._queue = None
+        self._threads = []
+        self._pid = None
+
+    def send(self, message):
+        try:
+            sender, recipient, data, message_id = build_mime(message)
+            # Addresses go on the wire as-is; SMTPUTF8 is not negotiated
+            f"{sender}{recipient}".encode('ascii')
+        except Exception as e:
+            return SendResult(None, f"Could not build message: {str(e)}", None, False)
+
+        future = Future()
+        self._ensure_started().put(((sender, recipient, data), future))
+        code, error = future.result()
+        if error is None:
+            return SendResult(code, None, message_id)
+        # 4xx replies are temporary, 5xx permanent; no reply at all means the connection failed
+        return SendResult(None, error, None, 400 <= code < 500 if code else True)
+
+    def _ensure_started(self):
+        """Start the connection threads for this process (again after a fork)"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                self._threads = []
+            if not self._threads:
+                for i in range(self.pool_size):
+                    thread = threading.Thread(target=self._run, args=(self._queue,),
+                                              name=f'smtp-connection-{i}', daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+            return self._queue
+
+    def _run(self, work):
+        connection = _SMTPConnection(self)
+        while True:
+            try:
+                item = work.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                connection.close()
+                continue
+            batch = []
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.pipeline_depth:
+                    break
+                try:
+                    item = work.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._send(connection, batch)
+            if item is None:
+                connection.close()
+                return
+
+    def _send(self, connection, batch):
+        try:
+            results = connection.send_batch([data for data, _ in batch])
+        except Exception as e:
+            # Could not connect or authenticate
+            import smtplib
+            code = None
+            if isinstance(e, smtplib.SMTPResponseException):
+                code = e.smtp_code
+                error = smtp_error(e.smtp_code, e.smtp_error)
+            else:
+                error = f"SMTP connection error: {str(e) or type(e).__name__}"
+            logger.error(f"Could not send {len(batch)} messages through {self.host}:{self.port}: {error}")
+            results = [(code, error)] * len(batch)
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def close(self):
+        """Finish queued messages, then QUIT every connection"""
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            for _ in self._threads:
+                self._queue.put(None)
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join(self.timeout)
+
+
+TRANSPORTS = {'sendgrid': SendGridTransport, 'smtp': SMTPTransport}
+
+_transport = None
+_transport_pid = None
+_transport_lock = threading.Lock()
+
+
+def create_transport(name=None):
+    """Build a transport by name (defaults to MAIL_TRANSPORT)"""
+    name = (name or MAIL_TRANSPORT).lower()
+    if name not in TRANSPORTS:
+        raise ValueError(f"Unknown MAIL_TRANSPORT: {name} (expected one of {', '.join(TRANSPORTS)})")
+    return TRANSPORTS[name]()
+
+
+def get_transport():
+    """Shared transport for the process, created on first use (again after a fork)"""
+    global _transport, _transport_pid
+    with _transport_lock:
+        if _transport is None or _transport_pid != os.getpid():
+            _transport = create_transport()
+            _transport_pid = os.getpid()
+        return _transport
@@ -0,0 +1,257 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import logging
+from collections import deque, OrderedDict
+from contextlib import closing
+from datetime import datetime
+
+from background import LOGS_DIR
+
+logger = logging.getLogger(__name__)
+
+# Latest event per channel, shared by every worker process on the host
+PROGRESS_DB = os.path.join(LOGS_DIR, 'progress.db')
+# How often each process looks for progress published by other workers (seconds)
+PROGRESS_POLL_INTERVAL = float(os.getenv('PROGRESS_POLL_INTERVAL', 0.5))
+
+# Events buffered per watcher; a slow client only ever loses its oldest events
+SUBSCRIBER_BUFFER_SIZE = 64
+# Completed campaigns whose final event is replayed to late watchers
+MAX_RETAINED_CHANNELS = 100
+# Campaigns stored by other workers are only replayed if they published within this many seconds
+RETAINED_SECONDS = 3600
+# Publish progress every N recipients, or at least this often (seconds)
+PROGRESS_BATCH_SIZE = 25
+PROGRESS_INTERVAL = 1.0
+
+
+class Subscription:
+    """A single watcher's bounded event buffer"""
+
+    def __init__(self, channel, maxlen=SUBSCRIBER_BUFFER_SIZE):
+        self.channel = channel
+        self.events = deque(maxlen=maxlen)
+        self.ready = threading.Event()
+
+    def push(self, event):
+        # deque(maxlen) drops the oldest event instead of blocking the publisher
+        self.events.append(event)
+        self.ready.set()
+
+    def get(self, timeout=None):
+        """Wait up to timeout seconds and return all buffered events (possibly none)"""
+        if not self.events:
+            self.ready.wait(timeout)
+        self.ready.clear()
+        drained = []
+        while self.events:
+            drained.append(self.events.popleft())
+        return drained
+
+
+class ProgressBus:
+    """
+    Publish/subscribe bus for campaign progress.
+
+    Publishing never blocks on watchers: each subscription has its own bounded
+    buffer. The latest event per channel is retained so that watchers which
+    connect mid-campaign see the current state immediately. Subscribing with
+    channel=None receives events from every channel.
+
+    With a db_path, the latest event per channel is also written to SQLite,
+    and one thread per process (started by the first watcher) polls it for
+    events published by other worker processes. A campaign sent by one
+    gunicorn worker can then be watched through any other.
+    """
+
+    def __init__(self, db_path=None, poll_interval=PROGRESS_POLL_INTERVAL):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._latest = OrderedDict()
+        self.db_path = db_path
+        self.poll_interval = poll_interval
+        self._seen_seq = 0
+        self._poller = None
+        self._poller_pid = None
+        if db_path:
+            directory = os.path.dirname(db_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            with closing(self._connect()) as conn:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS progress ('
+                    'channel TEXT PRIMARY KEY, seq INTEGER NOT NULL, pid INTEGER NOT NULL, event TEXT NOT NULL, '
+                    'updated_at REAL NOT NULL)'
+                )
+                conn.execute('CREATE INDEX IF NOT EXISTS progress_seq ON progress (seq)')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=5)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def subscribe(self, channel=None):
+        if self.db_path:
+            self._ensure_polling()
+            # Pick up campaigns running in other workers before replaying the latest state
+            self._sync()
+        subscription = Subscription(channel)
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(subscription)
+            if channel is None:
+                for event in self._latest.values():
+                    subscription.push(event)
+            elif channel in self._latest:
+                subscription.push(self._latest[channel])
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            watchers = self._subscribers.get(subscription.channel)
+            if watchers:
+                watchers.discard(subscription)
+                if not watchers:
+                    del self._subscribers[subscription.channel]
+
+    def publish(self, channel, event):
+        self._deliver(channel, event)
+        if self.db_path:
+            self._store(channel, event)
+
+    def _deliver(self, channel, event):
+        with self._lock:
+            self._latest[channel] = event
+            self._latest.move_to_end(channel)
+            while len(self._latest) > MAX_RETAINED_CHANNELS:
+                self._latest.popitem(last=False)
+            watchers = list(self._subscribers.get(channel, ())) + list(self._subscribers.get(None, ()))
+        for subscription in watchers:
+            subscription.push(event)
+
+    def _store(self, channel, event):
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO progress (channel, seq, pid, event, updated_at) '
+                    'VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM progress), ?, ?, ?)',
+                    (channel, os.getpid(), json.dumps(event), time.time())
+                )
+                if event.get('status') != 'running':
+                    conn.execute(
+                        'DELETE FROM progress WHERE seq <= '
+                        '(SELECT seq FROM progress ORDER BY seq DESC LIMIT 1 OFFSET ?)',
+                        (MAX_RETAINED_CHANNELS,)
+                    )
+        except sqlite3.Error as e:
+            # Progress is best effort; a busy or broken store must never stop a send
+            logger.warning(f"Could not share progress for {channel}: {str(e)}")
+
+    def _sync(self):
+        """Deliver events that other worker processes stored since the last call"""
+        try:
+            with closing(self._connect()) as conn:
+                rows = conn.execute(
+                    'SELECT seq, channel, pid, event FROM progress WHERE seq > ? AND updated_at > ? ORDER BY seq',
+                    (self._seen_seq, time.time() - RETAINED_SECONDS)
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"Could not read shared progress: {str(e)}")
+            return
+        pid = os.getpid()
+        for seq, channel, publisher, event in rows:
+            self._seen_seq = max(self._seen_seq, seq)
+            if publisher != pid:
+                self._deliver(channel, json.loads(event))
+
+    def _ensure_polling(self):
+        """Start this process's store poller (again after a fork)"""
+        with self._lock:
+            if self._poller is not None and self._poller_pid == os.getpid() and self._poller.is_alive():
+                return
+            self._poller_pid = os.getpid()
+            self._poller = threading.Thread(target=self._poll, name='progress-poller', daemon=True)
+            self._poller.start()
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            if self._subscribers:
+                self._sync()
+
+    def stream(self, channel=None, keepalive=15):
+        """Generator of Server-Sent Events text for the given channel"""
+        subscription = self.subscribe(channel)
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                events = subscription.get(timeout=keepalive)
+                if not events:
+                    # Comment line keeps proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+                    continue
+                for event in events:
+                    yield f"event: progress\ndata: {json.dumps(event)}\n\n"
+        finally:
+            self.unsubscribe(subscription)
+
+
+class ProgressTracker:
+    """Counts outcomes in a send loop and publishes per-batch progress events"""
+
+    def __init__(self, bus, campaign_id, total, channel=None, template=None, subject=None):
+        self.bus = bus
+        self.campaign_id = campaign_id
+        self.channel = channel or campaign_id
+        self.total = total
+        self.template = template
+        self.subject = subject
+        self.sent = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self._last_publish = 0.0
+
+    def _event(self, status):
+        processed = self.sent + self.failed
+        elapsed = time.monotonic() - self.started
+        rate = processed / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.total - processed, 0)
+        return {
+            'campaign_id': self.campaign_id,
+            'channel': self.channel,
+            'status': status,
+            'template': self.template,
+            'subject': self.subject,
+            'total': self.total,
+            'sent': self.sent,
+            'failed': self.failed,
+            'processed': processed,
+            'rate': round(rate, 2),
+            'eta_seconds': round(remaining / rate, 1) if rate > 0 else None,
+            'timestamp': datetime.now().isoformat()
+        }
+
+    def start(self):
+        self._last_publish = time.monotonic()
+        self.bus.publish(self.channel, self._event('running'))
+
+    def record(self, success):
+        if success:
+            self.sent += 1
+        else:
+            self.failed += 1
+        processed = self.sent + self.failed
+        now = time.monotonic()
+        if processed % PROGRESS_BATCH_SIZE == 0 or now - self._last_publish >= PROGRESS_INTERVAL:
+            self._last_publish = now
+            self.bus.publish(self.channel, self._event('running'))
+
+    def finish(self, status='completed'):
+        self.bus.publish(self.channel, self._event(status))
+
+
+# Shared bus for the process, backed by a store every worker can read
+progress_bus = ProgressBus(PROGRESS_DB)
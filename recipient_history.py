@@ -0,0 +1,325 @@
+import os
+import glob
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+from contextlib import closing
+from datetime import datetime
+
+from background import LOGS_DIR
+
+logger = logging.getLogger(__name__)
+
+HISTORY_DB = os.path.join(LOGS_DIR, 'recipient_history.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recipients (
+    id INTEGER PRIMARY KEY,
+    email TEXT NOT NULL UNIQUE,
+    last_status TEXT,
+    last_campaign_id TEXT,
+    last_template TEXT,
+    last_sent_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS sends (
+    recipient_id INTEGER NOT NULL,
+    campaign_id TEXT NOT NULL,
+    template TEXT,
+    status TEXT NOT NULL,
+    sent_at INTEGER NOT NULL,
+    UNIQUE (recipient_id, campaign_id)
+);
+CREATE TABLE IF NOT EXISTS suppressions (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient_id INTEGER NOT NULL UNIQUE,
+    reason TEXT,
+    created_at INTEGER
+);
+"""
+
+# SQLite's default limit on bound parameters per statement is 999
+ID_CHUNK = 900
+
+
+def _epoch(timestamp):
+    """ISO timestamp (as written to batch summaries) to integer epoch seconds"""
+    if not timestamp:
+        return int(time.time())
+    try:
+        return int(datetime.fromisoformat(timestamp).timestamp())
+    except ValueError:
+        return int(time.time())
+
+
+class _AudienceIndex:
+    """
+    In-memory NumPy mirror of the sends and suppressions tables.
+
+    Per template it holds parallel arrays of recipient id, send time and a
+    success flag; suppressed recipients are a boolean array indexed by id. New
+    rows are pulled from SQLite by rowid high-water mark before each query, so
+    sends recorded by other workers are picked up incrementally.
+    """
+
+    def __init__(self):
+        self.sends_seen = 0
+        self.suppressions_seen = 0
+        self.chunks = {}   # template -> list of (ids, sent_at, ok) array chunks
+        self.arrays = {}   # template -> concatenated (ids, sent_at, ok)
+        self.suppressed = None
+        self.max_id = 0
+
+    def sync(self, conn):
+        import numpy as np
+
+        high_water = conn.execute('SELECT MAX(rowid) FROM sends').fetchone()[0] or 0
+        if high_water > self.sends_seen:
+            window = (self.sends_seen, high_water)
+            templates = [row[0] for row in conn.execute(
+                'SELECT DISTINCT template FROM sends WHERE rowid > ? AND rowid <= ?', window
+            )]
+            for template in templates:
+                # fromiter builds the arrays straight from the cursor without per-row Python objects
+                rows = np.fromiter(
+                    conn.execute(
+                        "SELECT recipient_id, sent_at, status = 'success' FROM sends "
+                        "WHERE rowid > ? AND rowid <= ? AND template IS ?",
+                        window + (template,)
+                    ),
+                    dtype=[('id', np.int64), ('sent_at', np.int64), ('ok', bool)]
+                )
+                if len(rows):
+                    self.chunks.setdefault(template, []).append((rows['id'], rows['sent_at'], rows['ok']))
+                    self.arrays.pop(template, None)
+                    self.max_id = max(self.max_id, int(rows['id'].max()))
+            self.sends_seen = high_water
+
+        suppressed = conn.execute(
+            'SELECT seq, recipient_id FROM suppressions WHERE seq > ? ORDER BY seq', (self.suppressions_seen,)
+        ).fetchall()
+        if suppressed:
+            self.suppressions_seen = suppressed[-1][0]
+            self.max_id = max(self.max_id, max(recipient_id for _, recipient_id in suppressed))
+        self._grow_suppressed(np)
+        if suppressed:
+            self.suppressed[[recipient_id for _, recipient_id in suppressed]] = True
+
+    def _grow_suppressed(self, np):
+        size = self.max_id + 1
+        if self.suppressed is None:
+            self.suppressed = np.zeros(size, dtype=bool)
+        elif len(self.suppressed) < size:
+            grown = np.zeros(max(size, len(self.suppressed) * 2), dtype=bool)
+            grown[:len(self.suppressed)] = self.suppressed
+            self.suppressed = grown
+
+    def template_arrays(self, template):
+        import numpy as np
+
+        if template not in self.arrays:
+            chunks = self.chunks.get(template)
+            if not chunks:
+                return None
+            self.arrays[template] = tuple(np.concatenate(parts) for parts in zip(*chunks))
+            self.chunks[template] = [self.arrays[template]]
+        return self.arrays[template]
+
+    def select(self, template, within_days, exclude_templates, exclude_bounced):
+        """Return the sorted unique recipient ids matching the filter"""
+        import numpy as np
+
+        arrays = self.template_arrays(template)
+        if arrays is None:
+            return np.zeros(0, dtype=np.int64)
+        ids, sent_at, ok = arrays
+        mask = ok
+        if within_days is not None:
+            mask = mask & (sent_at >= int(time.time()) - int(within_days * 86400))
+        candidates = ids[mask]
+
+        excluded = self.suppressed.copy() if exclude_bounced else np.zeros(len(self.suppressed), dtype=bool)
+        for other in exclude_templates:
+            other_arrays = self.template_arrays(other)
+            if other_arrays is not None:
+                # Only people who actually received the other template; a failed attempt does not count
+                other_ids, _, other_ok = other_arrays
+                excluded[other_ids[other_ok]] = True
+        return np.unique(candidates[~excluded[candidates]])
+
+
+class RecipientHistory:
+    """
+    Persistent per-address send history.
+
+    SQLite is the durable store: every campaign's outcomes are added when its
+    batch summary is saved, and bounces/drops/spam reports from the Event
+    Webhook mark the address as suppressed. Audience filters such as "got
+    template 1 in the last 14 days but not template 3" run against an
+    in-memory NumPy index of the same data, which is kept in sync incrementally.
+    """
+
+    def __init__(self, db_path=HISTORY_DB):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._index = _AudienceIndex()
+        directory = os.path.dirname(db_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        # A connection per call keeps this safe to use from any thread or worker
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def record_campaign(self, batch_data, update_existing=False):
+        """
+        Add every recipient outcome of a campaign (a BulkEmailSender batch_data dict).
+        update_existing replaces outcomes already recorded for the campaign, e.g.
+        after a successful retry.
+        """
+        campaign_id = batch_data.get('campaign_id')
+        template = batch_data.get('template')
+        rows = [
+            (r['email'].strip().lower(), r.get('status', 'unknown'), _epoch(r.get('timestamp')))
+            for r in batch_data.get('recipients', [])
+            if r.get('email')
+        ]
+        if not rows:
+            return 0
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                """
+                INSERT INTO recipients (email, last_status, last_campaign_id, last_template, last_sent_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(email) DO UPDATE SET
+                    last_status = excluded.last_status,
+                    last_campaign_id = excluded.last_campaign_id,
+                    last_template = excluded.last_template,
+                    last_sent_at = excluded.last_sent_at
+                WHERE recipients.last_sent_at IS NULL OR excluded.last_sent_at >= recipients.last_sent_at
+                """,
+                [(email, status, campaign_id, template, sent_at) for email, status, sent_at in rows]
+            )
+            # OR IGNORE makes re-recording a campaign (e.g. a rebuild) a no-op; OR REPLACE
+            # gives the updated row a new rowid so the audience index picks it up
+            conflict = 'REPLACE' if update_existing else 'IGNORE'
+            conn.executemany(
+                f"""
+                INSERT OR {conflict} INTO sends (recipient_id, campaign_id, template, status, sent_at)
+                SELECT id, ?, ?, ?, ? FROM recipients WHERE email = ?
+                """,
+                [(campaign_id, template, status, sent_at, email) for email, status, sent_at in rows]
+            )
+        logger.info(f"Recorded {len(rows)} recipients of campaign {campaign_id} in recipient history")
+        return len(rows)
+
+    def mark_bounced(self, emails, reason='bounced'):
+        """Suppress addresses reported as bounced/dropped/spam so follow-ups skip them"""
+        emails = [email.strip().lower() for email in emails if email]
+        if not emails:
+            return
+        now = int(time.time())
+        with closing(self._connect()) as conn, conn:
+            conn.executemany('INSERT OR IGNORE INTO recipients (email) VALUES (?)', [(email,) for email in emails])
+            conn.executemany(
+                """
+                INSERT OR IGNORE INTO suppressions (recipient_id, reason, created_at)
+                SELECT id, ?, ? FROM recipients WHERE email = ?
+                """,
+                [(reason, now, email) for email in emails]
+            )
+
+    def lookup(self, email):
+        """Return the recorded history of one address"""
+        email = email.strip().lower()
+        with closing(self._connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            recipient = conn.execute(
+                """
+                SELECT r.*, s.reason AS suppressed FROM recipients r
+                LEFT JOIN suppressions s ON s.recipient_id = r.id WHERE r.email = ?
+                """,
+                (email,)
+            ).fetchone()
+            if recipient is None:
+                return None
+            sends = conn.execute(
+                'SELECT campaign_id, template, status, sent_at FROM sends WHERE recipient_id = ? ORDER BY sent_at',
+                (recipient['id'],)
+            ).fetchall()
+        history = dict(recipient)
+        history['sends'] = [dict(row) for row in sends]
+        return history
+
+    def _select(self, conn, template, within_days, exclude_templates, exclude_bounced):
+        with self._lock:
+            self._index.sync(conn)
+            return self._index.select(template, within_days, list(exclude_templates), exclude_bounced)
+
+    def audience(self, template, within_days=None, exclude_templates=(), exclude_bounced=True, limit=None):
+        """
+        Addresses that successfully received template (optionally within the last
+        within_days days), never received any of exclude_templates and, by
+        default, are not suppressed.
+        """
+        return list(self.iter_audience(template, within_days, exclude_templates, exclude_bounced, limit))
+
+    def iter_audience(self, template, within_days=None, exclude_templates=(), exclude_bounced=True, limit=None):
+        """Like audience(), but yields the addresses a chunk at a time instead of building one list"""
+        with closing(self._connect()) as conn:
+            ids = self._select(conn, template, within_days, exclude_templates, exclude_bounced)
+            if limit:
+                ids = ids[:int(limit)]
+            for start in range(0, len(ids), ID_CHUNK):
+                chunk = ids[start:start + ID_CHUNK].tolist()
+                placeholders = ', '.join('?' for _ in chunk)
+                for row in conn.execute(f'SELECT email FROM recipients WHERE id IN ({placeholders}) ORDER BY id', chunk):
+                    yield row[0]
+
+    def audience_count(self, template, within_days=None, exclude_templates=(), exclude_bounced=True):
+        with closing(self._connect()) as conn:
+            return int(len(self._select(conn, template, within_days, exclude_templates, exclude_bounced)))
+
+    def rebuild(self, logs_dir=LOGS_DIR):
+        """Backfill the index from every batch summary on disk"""
+        total = 0
+        for path in sorted(glob.glob(os.path.join(logs_dir, 'email_batch_*_summary.json'))):
+            try:
+                with open(path, 'r') as f:
+                    total += self.record_campaign(json.load(f))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping unreadable summary {path}: {str(e)}")
+        return total
+
+
+# Shared history index for the process
+recipient_history = RecipientHistory()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query or rebuild the recipient history index')
+    parser.add_argument('--rebuild', action='store_true', help='Backfill from all batch summaries in email_logs/')
+    parser.add_argument('--template', help='Audience: recipients who received this template')
+    parser.add_argument('--days', type=float, default=None, help='Audience: only sends in the last N days')
+    parser.add_argument('--exclude', action='append', default=[], help='Audience: skip anyone who got this template')
+    parser.add_argument('--include-bounced', action='store_true', help='Audience: keep bounced addresses')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.rebuild:
+        print(f"Indexed {recipient_history.rebuild()} recipient sends")
+    if args.template:
+        for email in recipient_history.audience(args.template, args.days, args.exclude,
+                                                exclude_bounced=not args.include_bounced):
+            print(email)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+import os
+import re
+import json
+import time
+import random
+import sqlite3
+import logging
+import argparse
+from contextlib import closing
+from datetime import datetime
+
+from background import LOGS_DIR, BackgroundWorker
+from domain_throttle import DomainThrottledSender, recipient_domain
+from recipient_history import recipient_history
+from mail_transport import get_transport
+from campaign_state import summary_lock, write_summary_unlocked
+
+logger = logging.getLogger(__name__)
+
+RETRY_DB = os.path.join(LOGS_DIR, 'retry_queue.db')
+
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', 6))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 30))     # Seconds before the first retry
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 3600))     # Cap on the backoff delay
+RETRY_BATCH_SIZE = int(os.getenv('RETRY_BATCH_SIZE', 200))      # Due items sent per round
+RETRY_WORKERS = int(os.getenv('RETRY_WORKERS', 4))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS retries (
+    id INTEGER PRIMARY KEY,
+    campaign_id TEXT NOT NULL,
+    summary_file TEXT NOT NULL,
+    email TEXT NOT NULL,
+    message TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS retries_due ON retries (status, next_attempt_at);
+"""
+
+# Errors from the SMTP transport carry the SMTP reply code, e.g. "SMTP 451: ..."
+SMTP_ERROR_PATTERN = re.compile(r'SMTP ([245])\d\d\b')
+
+# Only used when the transport could not classify a failure itself (and for summaries written before it did)
+TRANSIENT_ERROR_MARKERS = ['timed out', 'timeout', 'connection', 'temporarily', 'temporary failure',
+                           'network', 'reset by peer', 'broken pipe', 'remote end closed', 'urlopen error',
+                           'name or service not known', 'unexpected_eof', 'incompleteread']
+
+
+def failure_status_code(status_code=None, error=None):
+    """HTTP status of a failed send, taken from the response or parsed from the error text"""
+    if status_code:
+        return int(status_code)
+    match = re.search(r'\b([45]\d\d)\b', str(error or ''))
+    return int(match.group(1)) if match else None
+
+
+def is_transient_failure(status_code=None, error=None, transient=None):
+    """
+    True for failures worth retrying: timeouts and connection errors, 429 and
+    5xx responses. Other 4xx responses (validation, auth) are permanent.
+    SMTP replies are the other way round: 4xx is temporary, 5xx permanent.
+    A transport's own classification (SendResult.transient) wins when given.
+    """
+    if transient is not None:
+        return transient
+    smtp = SMTP_ERROR_PATTERN.match(str(error or ''))
+    if smtp:
+        return smtp.group(1) == '4'
+    code = failure_status_code(status_code, error)
+    if code is not None:
+        return code == 429 or code == 408 or 500 <= code < 600
+    text = str(error or '').lower()
+    return any(marker in text for marker in TRANSIENT_ERROR_MARKERS)
+
+
+def backoff_delay(attempts, base=RETRY_BASE_DELAY, cap=RETRY_MAX_DELAY):
+    """Exponential backoff with jitter: between half and all of base * 2^(attempts - 1), capped"""
+    delay = min(cap, base * (2 ** max(attempts - 1, 0)))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def apply_retry_outcomes(summary_file, outcomes):
+    """
+    Fold retry results into a campaign's batch summary.
+
+    outcomes maps an address to {'status': 'success' | 'failed', 'attempts': n,
+    'error': ..., 'response_code': ...}. Successful retries move the address
+    from the failed to the successful counts (overall and per domain).
+    Returns the summary's top-level fields and the recipient entries that
+    changed. The summary is streamed, never loaded whole, and rewritten under
+    its lock, so updates from several worker processes never interleave.
+    """
+    with summary_lock(summary_file):
+        return _apply_retry_outcomes(summary_file, outcomes)
+
+
+def _retried_entry(entry, outcome, now):
+    entry = dict(entry, attempts=outcome['attempts'], timestamp=now)
+    if outcome['status'] == 'success':
+        entry['status'] = 'success'
+        entry['retry'] = 'succeeded'
+        entry['response_code'] = outcome.get('response_code')
+        entry.pop('error', None)
+    else:
+        entry['retry'] = 'gave_up'
+        entry['error'] = outcome.get('error') or entry.get('error')
+    return entry
+
+
+def _apply_retry_outcomes(summary_file, outcomes):
+    # Summaries can hold millions of recipients, so they are streamed twice rather than loaded:
+    # once to find the retried entries and read the fields, once to write the updated copy
+    from campaign_export import iter_summary
+
+    now = datetime.now().isoformat()
+    fields = {}
+    lists = []     # Top-level list names in file order
+    changed = {}   # index in 'recipients' -> updated entry
+    index = 0
+    for kind, key, value in iter_summary(summary_file):
+        if kind == 'field':
+            fields[key] = value
+            continue
+        if key not in lists:
+            lists.append(key)
+        if key == 'recipients':
+            outcome = outcomes.get(value.get('email'))
+            if outcome is not None and value.get('status') == 'failed' and value.get('retry') == 'queued':
+                changed[index] = _retried_entry(value, outcome, now)
+            index += 1
+
+    if not changed:
+        return fields, []
+
+    for entry in changed.values():
+        if entry['status'] != 'success':
+            continue
+        fields['successful_emails'] = fields.get('successful_emails', 0) + 1
+        fields['failed_emails'] = max(fields.get('failed_emails', 0) - 1, 0)
+        domain = fields.get('domains', {}).get(recipient_domain(entry['email']) or 'unknown')
+        if domain:
+            domain['successful'] += 1
+            domain['failed'] = max(domain['failed'] - 1, 0)
+    total = fields.get('total_emails', 0)
+    if total > 0:
+        fields['success_rate'] = f"{(fields['successful_emails'] / total) * 100:.2f}%"
+    fields['retried_at'] = now
+
+    # The lists are copied from one more pass over the file, in the order they appear in it
+    stream = ((key, value) for kind, key, value in iter_summary(summary_file) if kind == 'item')
+    lookahead = []
+
+    def items(name):
+        position = 0
+        while True:
+            event = lookahead.pop() if lookahead else next(stream, None)
+            if event is None:
+                return
+            if event[0] != name:
+                lookahead.append(event)
+                return
+            yield changed.get(position, event[1]) if name == 'recipients' else event[1]
+            position += 1
+
+    names = lists + [name for name in ('recipients', 'errors') if name not in lists]
+    write_summary_unlocked(summary_file, fields, {name: items(name) for name in names})
+    return fields, list(changed.values())
+
+
+class RetryQueue(BackgroundWorker):
+    """
+    Durable queue of sends that failed with a transient error.
+
+    Campaigns enqueue their transient failures once the batch summary is
+    saved. A background thread sends the items that are due, respecting the
+    per-domain throttle. Each failure pushes an item back with exponential
+    backoff and jitter until RETRY_MAX_ATTEMPTS. Outcomes are written back into
+    the original campaign's summary and the recipient history. Only one worker
+    process drains the queue at a time, guarded by a file lock.
+    """
+
+    thread_name = 'retry-worker'
+
+    def __init__(self, db_path=RETRY_DB, interval=5.0, send_fn=None):
+        super().__init__(db_path + '.lock', interval)
+        self.db_path = db_path
+        self._send_fn = send_fn or send_message
+        directory = os.path.dirname(db_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def enqueue(self, campaign_id, summary_file, items):
+        """
+        Queue (email, message) pairs for retry, where message is the dict that
+        send_message() builds the email from. Returns the number queued.
+        """
+        now = time.time()
+        rows = [
+            (campaign_id, summary_file, email, json.dumps(message), now + backoff_delay(1), now, now)
+            for email, message in items
+        ]
+        if not rows:
+            return 0
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                """
+                INSERT INTO retries (campaign_id, summary_file, email, message, next_attempt_at, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                rows
+            )
+        logger.info(f"Queued {len(rows)} transient failures of campaign {campaign_id} for retry")
+        self.ensure_started()
+        return len(rows)
+
+    def drain(self):
+        """
+        Send one round of due retries.
+        Returns the number of items attempted, or None if another worker holds the lock.
+        """
+        return self.run_pass()
+
+    def _work(self):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            due = conn.execute(
+                """
+                SELECT id, campaign_id, summary_file, email, message, attempts FROM retries
+                WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?
+                """,
+                (now, RETRY_BATCH_SIZE)
+            ).fetchall()
+        if not due:
+            return 0
+
+        # The throttled sender is keyed by address, so an address queued by
+        # several campaigns is sent once per round
+        items = {}
+        for row in due:
+            items.setdefault(row[3], row)
+
+        outcomes = {}   # summary file -> {email: outcome}
+        updates = []    # (status, attempts, next_attempt_at, last_error, updated_at, id)
+        for email, result in DomainThrottledSender(max_workers=RETRY_WORKERS).run(
+                list(items), lambda to: self._attempt(items[to]), on_error=lambda to, e: (None, str(e), None)):
+            item_id, campaign_id, summary_file, _, _, attempts = items[email]
+            attempts += 1
+            status_code, error, transient = result
+            now = time.time()
+            if error is None:
+                logger.info(f"Retry {attempts} of {email} for campaign {campaign_id} succeeded")
+                updates.append(('sent', attempts, now, None, now, item_id))
+                outcome = {'status': 'success', 'attempts': attempts, 'response_code': status_code}
+            elif is_transient_failure(status_code, error, transient) and attempts < RETRY_MAX_ATTEMPTS:
+                logger.warning(f"Retry {attempts} of {email} for campaign {campaign_id} failed: "
+                               f"{error or status_code}")
+                updates.append(('pending', attempts, now + backoff_delay(attempts + 1),
+                                error or f"Status code: {status_code}", now, item_id))
+                continue
+            else:
+                logger.error(f"Giving up on {email} for campaign {campaign_id} after {attempts} attempts: "
+                             f"{error or status_code}")
+                updates.append(('failed', attempts, now, error or f"Status code: {status_code}", now, item_id))
+                outcome = {'status': 'failed', 'attempts': attempts, 'error': error or f"Status code: {status_code}"}
+            outcomes.setdefault(summary_file, {})[email] = outcome
+
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                'UPDATE retries SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ? '
+                'WHERE id = ?',
+                updates
+            )
+
+        for summary_file, summary_outcomes in outcomes.items():
+            try:
+                fields, changed = apply_retry_outcomes(summary_file, summary_outcomes)
+                recipient_history.record_campaign(
+                    dict(fields, recipients=[entry for entry in changed if entry['status'] == 'success']),
+                    update_existing=True
+                )
+            except (OSError, ValueError) as e:
+                logger.error(f"Could not update campaign summary {summary_file}: {str(e)}")
+        return len(items)
+
+    def _attempt(self, row):
+        email = row[3]
+        history = recipient_history.lookup(email)
+        if history and history.get('suppressed'):
+            # Bounced or reported since the first attempt; do not send again
+            return None, f"Suppressed ({history['suppressed']})", False
+        return self._send_fn(json.loads(row[4]))
+
+    def pending_template_paths(self):
+        """Template files that pending retries will still send from"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT DISTINCT json_extract(message, '$.template_path') FROM retries WHERE status = 'pending'"
+            ).fetchall()
+        return {row[0] for row in rows if row[0]}
+
+    def stats(self):
+        """Item counts by status"""
+        with closing(self._connect()) as conn:
+            counts = dict(conn.execute('SELECT status, COUNT(*) FROM retries GROUP BY status').fetchall())
+        return {status: counts.get(status, 0) for status in ('pending', 'sent', 'failed')}
+
+
+_template_cache = {}
+
+
+def send_message(message):
+    """
+    Send one queued message through the configured mail transport and return
+    (status_code, error, transient); error is None on success and transient
+    is the transport's classification of a failure (None if it has none).
+
+    message holds from_email, from_name, to, subject, template_path, and
+    optionally name (substituted for {Name}), custom_args, headers and
+    reply_to ([email, name]).
+    """
+    try:
+        template_path = message['template_path']
+        if template_path not in _template_cache:
+            with open(template_path, 'r') as f:
+                _template_cache[template_path] = f.read()
+        html = _template_cache[template_path]
+        if message.get('name') is not None:
+            html = html.replace('{Name}', message['name'])
+        result = get_transport().send(dict(message, html=html))
+        return result.status_code, result.error, result.transient
+    except Exception as e:
+        return getattr(e, 'status_code', None), str(e), None
+
+
+# Shared queue for the process
+retry_queue = RetryQueue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or drain the send retry queue')
+    parser.add_argument('--drain', action='store_true', help='Send every due retry now and exit')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.drain:
+        while retry_queue.drain():
+            pass
+    print(json.dumps(retry_queue.stats()))
+
+
+if __name__ == "__main__":
+    main()
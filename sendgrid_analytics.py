@@ -1,5 +1,4 @@
 import os
-import requests
 from datetime import datetime, timedelta
 import json
 import logging
@@ -20,6 +19,8 @@ class SendGridAnalytics:
 
     def _make_request(self, url, params=None):
         """Helper method to make API requests with proper error handling"""
+        import requests  # Only needed when the dashboard actually polls SendGrid
+
         try:
             response = requests.get(url, headers=self.headers, params=params)
             response.raise_for_status()  # Raise an exception for bad status codes
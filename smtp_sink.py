@@ -0,0 +1,230 @@
+"""
+Local SMTP server stand-in and throughput benchmark for the SMTP transport.
+
+The sink speaks enough ESMTP (EHLO with PIPELINING, MAIL, RCPT, DATA, RSET,
+NOOP, QUIT) to accept mail from the app and discard it. It can add latency
+to every network read to mimic a remote relay. Recipients starting with
+"bad" are refused with 550 and those starting with "busy" with 451, so both
+failure paths can be exercised.
+
+Usage:
+    python smtp_sink.py --serve --port 2525
+        then run the app with MAIL_TRANSPORT=smtp SMTP_HOST=localhost SMTP_PORT=2525
+        SMTP_SECURITY=none SMTP_USERNAME=
+    python smtp_sink.py --messages 5000 --latency 20 --threads 32
+
+The benchmark sends the same messages four ways: a new connection per
+message, persistent connections, PIPELINING with DATA, and PIPELINING with
+CHUNKING (BDAT).
+"""
+import sys
+import time
+import socket
+import argparse
+import threading
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+
+from mail_transport import SMTPTransport
+
+
+class SMTPSinkHandler(socketserver.BaseRequestHandler):
+    """Answers every complete command in a read with a single write, as a pipelining server may"""
+
+    def handle(self):
+        server = self.server
+        sock = self.request
+        sock.sendall(b'220 localhost SMTP sink ready\r\n')
+        buffer = b''
+        in_data = False
+        chunk_left = None  # Bytes of a BDAT chunk still to be read
+        recipient_ok = False
+        while True:
+            try:
+                chunk = sock.recv(65536)
+            except OSError:
+                return
+            if not chunk:
+                return
+            if server.latency:
+                time.sleep(server.latency)
+            buffer += chunk
+            replies = []
+            while True:
+                if chunk_left is not None:
+                    taken = min(chunk_left, len(buffer))
+                    buffer = buffer[taken:]
+                    chunk_left -= taken
+                    if chunk_left:
+                        break
+                    chunk_left = None
+                    if recipient_ok:
+                        server.count('delivered')
+                        replies.append(b'250 2.0.0 Ok: queued')
+                    else:
+                        replies.append(b'554 5.5.1 No valid recipients')
+                    recipient_ok = False
+                    continue
+                if in_data:
+                    end = buffer.find(b'\r\n.\r\n')
+                    if end == -1:
+                        break
+                    buffer = buffer[end + 5:]
+                    in_data = False
+                    server.count('delivered')
+                    replies.append(b'250 2.0.0 Ok: queued')
+                    continue
+                line, sep, rest = buffer.partition(b'\r\n')
+                if not sep:
+                    break
+                buffer = rest
+                command = line[:4].upper()
+                if command in (b'EHLO', b'HELO'):
+                    replies.append(b'250-localhost\r\n250-PIPELINING\r\n' +
+                                   (b'250-CHUNKING\r\n' if server.chunking else b'') + b'250 8BITMIME')
+                elif command == b'MAIL':
+                    replies.append(b'250 2.1.0 Ok')
+                elif command == b'RCPT':
+                    address = line.partition(b'<')[2].lower()
+                    if address.startswith(b'bad'):
+                        server.count('refused')
+                        replies.append(b'550 5.1.1 Recipient address rejected: User unknown')
+                    elif address.startswith(b'busy'):
+                        server.count('deferred')
+                        replies.append(b'451 4.7.1 Try again later')
+                    else:
+                        recipient_ok = True
+                        replies.append(b'250 2.1.5 Ok')
+                elif command == b'DATA':
+                    if recipient_ok:
+                        in_data = True
+                        replies.append(b'354 End data with <CR><LF>.<CR><LF>')
+                    else:
+                        replies.append(b'554 5.5.1 No valid recipients')
+                    recipient_ok = False
+                elif command == b'BDAT':
+                    # Only single-chunk "BDAT <size> LAST" messages are sent by the transport
+                    chunk_left = int(line.split()[1])
+                elif command in (b'RSET', b'NOOP'):
+                    recipient_ok = False
+                    replies.append(b'250 2.0.0 Ok')
+                elif command == b'QUIT':
+                    sock.sendall(b''.join(reply + b'\r\n' for reply in replies) + b'221 2.0.0 Bye\r\n')
+                    return
+                else:
+                    replies.append(b'502 5.5.2 Command not recognized')
+            if replies:
+                sock.sendall(b''.join(reply + b'\r\n' for reply in replies))
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024  # The reconnect benchmark opens many connections at once
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, chunking=True):
+        super().__init__((host, port), SMTPSinkHandler)
+        self.latency = latency
+        self.chunking = chunking
+        self.counts = {'delivered': 0, 'refused': 0, 'deferred': 0, 'connections': 0}
+        self._counts_lock = threading.Lock()
+
+    def count(self, key):
+        with self._counts_lock:
+            self.counts[key] += 1
+
+    def process_request(self, request, client_address):
+        request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.count('connections')
+        super().process_request(request, client_address)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='smtp-sink', daemon=True).start()
+        return self
+
+
+def benchmark_message(i):
+    return {
+        'from_email': 'origination@clean-earth.org',
+        'from_name': 'Clean Earth Renewables',
+        'to': f'user{i}@example.com',
+        'subject': f'Benchmark message {i}',
+        'html': '<html><body><p>Hello {Name}</p>\n.<p>A line starting with a dot</p></body></html>',
+        'custom_args': {'campaign_id': 'benchmark'}
+    }
+
+
+def run(sink, mode, messages, threads, pool_size):
+    """Send messages through the sink and return (seconds, failures)"""
+    port = sink.server_address[1]
+    if mode == 'reconnect':
+        # A fresh connection per message, as a naive smtplib loop would do
+        import smtplib
+        from mail_transport import build_mime
+
+        def send(i):
+            sender, recipient, data, _ = build_mime(benchmark_message(i))
+            try:
+                with smtplib.SMTP('127.0.0.1', port, timeout=30) as smtp:
+                    smtp.sendmail(sender, [recipient], data)
+                return None
+            except smtplib.SMTPException as e:
+                return str(e)
+        transport = None
+    else:
+        # The sink only offers CHUNKING (BDAT) in 'chunked' mode; new connections pick it up
+        sink.chunking = mode == 'chunked'
+        transport = SMTPTransport(host='127.0.0.1', port=port, username='', security='none', pool_size=pool_size,
+                                  pipeline_depth=1 if mode == 'persistent' else 50)
+
+        def send(i):
+            return transport.send(benchmark_message(i)).error
+
+    # Reconnecting senders get the same number of simultaneous connections as the pool
+    workers = pool_size if mode == 'reconnect' else threads
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        errors = [error for error in pool.map(send, range(messages)) if error]
+    elapsed = time.perf_counter() - start
+    if transport is not None:
+        transport.close()
+    return elapsed, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local SMTP stand-in and SMTP transport benchmark')
+    parser.add_argument('--serve', action='store_true', help='Only run the sink until interrupted')
+    parser.add_argument('--port', type=int, default=0, help='Sink port (default: any free port)')
+    parser.add_argument('--latency', type=float, default=10, help='Milliseconds added to every read by the sink')
+    parser.add_argument('--messages', type=int, default=2000, help='Messages per mode')
+    parser.add_argument('--threads', type=int, default=32, help='Concurrent senders (SEND_WORKERS)')
+    parser.add_argument('--pool-size', type=int, default=4, help='SMTP connections (SMTP_POOL_SIZE)')
+    args = parser.parse_args()
+
+    sink = SMTPSink(port=args.port, latency=args.latency / 1000)
+    if args.serve:
+        print(f"SMTP sink listening on {sink.server_address[0]}:{sink.server_address[1]}")
+        try:
+            sink.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+    sink.start()
+
+    failed = False
+    for mode in ('reconnect', 'persistent', 'pipelined', 'chunked'):
+        before = dict(sink.counts)
+        elapsed, errors = run(sink, mode, args.messages, args.threads, args.pool_size)
+        delivered = sink.counts['delivered'] - before['delivered']
+        connections = sink.counts['connections'] - before['connections']
+        print(f"{mode:>10}: {args.messages} messages in {elapsed:.2f}s ({args.messages / elapsed:,.0f}/s), "
+              f"{connections} connections, {delivered} delivered")
+        if errors or delivered != args.messages:
+            failed = True
+            print(f"{len(errors)} failed (e.g. {errors[:1]})")
+    sink.shutdown()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
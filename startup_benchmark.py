@@ -0,0 +1,147 @@
+"""
+Startup benchmark for the Flask app.
+
+Reports the `python -X importtime` cost of `import app`, the slowest imports,
+and the wall-clock time from interpreter launch to the first served request.
+Both are compared with the same measurements of a bare Flask app taken in the
+same runs, so the budgets are ratios that hold on fast and slow machines
+alike. Exits non-zero when a budget is exceeded or a heavy dependency is
+loaded at import time, so startup regressions are caught before they ship.
+
+Usage:
+    python startup_benchmark.py [--runs 5] [--top 15] [--max-import-ratio 1.6] [--max-first-request-ratio 2.0]
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Budgets as multiples of the bare Flask baseline (medians over runs). Flask itself is most of
+# the app's startup, so these bound what the app's own modules add on top of it
+MAX_IMPORT_RATIO = 1.6
+MAX_FIRST_REQUEST_RATIO = 2.0
+
+# Dependencies that must only be loaded on the code paths that need them
+LAZY_MODULES = ['pandas', 'numpy', 'sendgrid', 'plotly', 'requests', 'pytz']
+
+IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s+)(\S+)')
+
+FIRST_REQUEST_SCRIPT = """
+import sys, json
+import app
+client = app.app.test_client()
+response = client.get('/login')
+loaded = [m for m in %r if m in sys.modules]
+print(json.dumps({'status': response.status_code, 'loaded': loaded}))
+""" % (LAZY_MODULES,)
+
+# The same steps for a one-route Flask app: interpreter, Flask and the test client, nothing of ours
+BASELINE_REQUEST_SCRIPT = """
+import json
+import flask
+app = flask.Flask('baseline')
+app.route('/login')(lambda: 'ok')
+response = app.test_client().get('/login')
+print(json.dumps({'status': response.status_code, 'loaded': []}))
+"""
+
+
+def measure_import_time(module='app'):
+    """Run `import <module>` under -X importtime and return (total_us, {module: cumulative_us})"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=REPO_DIR, capture_output=True, text=True, check=True
+    )
+    modules = {}
+    total = 0
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        cumulative = int(match.group(2))
+        name = match.group(4)
+        modules[name] = cumulative
+        if name == module:
+            total = cumulative
+    return total, modules
+
+
+def measure_first_request(script=FIRST_REQUEST_SCRIPT):
+    """Return (elapsed_ms, result) from interpreter launch to the first /login response"""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-c', script],
+        cwd=REPO_DIR, capture_output=True, text=True, check=True
+    )
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    return elapsed_ms, json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure app startup cost')
+    parser.add_argument('--runs', type=int, default=5, help='Number of runs to take the median of')
+    parser.add_argument('--top', type=int, default=15, help='Number of slowest imports to list')
+    parser.add_argument('--max-import-ratio', type=float, default=MAX_IMPORT_RATIO,
+                        help='Allowed `import app` time as a multiple of `import flask`')
+    parser.add_argument('--max-first-request-ratio', type=float, default=MAX_FIRST_REQUEST_RATIO,
+                        help='Allowed time to first request as a multiple of a bare Flask app')
+    args = parser.parse_args()
+
+    import_totals = []
+    baseline_import_totals = []
+    first_request_times = []
+    baseline_request_times = []
+    modules = {}
+    loaded = set()
+    for _ in range(args.runs):
+        # Baseline and app are measured back to back so both see the same machine load
+        total, _ = measure_import_time('flask')
+        baseline_import_totals.append(total / 1000)
+        total, modules = measure_import_time()
+        import_totals.append(total / 1000)
+        elapsed_ms, _ = measure_first_request(BASELINE_REQUEST_SCRIPT)
+        baseline_request_times.append(elapsed_ms)
+        elapsed_ms, result = measure_first_request()
+        first_request_times.append(elapsed_ms)
+        loaded.update(result['loaded'])
+
+    import_ms = statistics.median(import_totals)
+    baseline_import_ms = statistics.median(baseline_import_totals)
+    first_request_ms = statistics.median(first_request_times)
+    baseline_request_ms = statistics.median(baseline_request_times)
+    import_ratio = import_ms / baseline_import_ms
+    first_request_ratio = first_request_ms / baseline_request_ms
+
+    print("Slowest imports (cumulative, last run):")
+    for name, cumulative in sorted(modules.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+    print()
+    print(f"import app:            {import_ms:8.1f} ms = {import_ratio:.2f}x import flask ({baseline_import_ms:.1f} ms), "
+          f"budget {args.max_import_ratio:.2f}x")
+    print(f"time to first request: {first_request_ms:8.1f} ms = {first_request_ratio:.2f}x bare Flask app "
+          f"({baseline_request_ms:.1f} ms), budget {args.max_first_request_ratio:.2f}x")
+
+    failures = []
+    if import_ratio > args.max_import_ratio:
+        failures.append(f"import app took {import_ratio:.2f}x as long as import flask")
+    if first_request_ratio > args.max_first_request_ratio:
+        failures.append(f"first request took {first_request_ratio:.2f}x as long as with a bare Flask app")
+    if loaded:
+        failures.append(f"heavy modules loaded at startup: {', '.join(sorted(loaded))}")
+
+    if failures:
+        print()
+        for failure in failures:
+            print(f"FAIL: {failure}")
+        sys.exit(1)
+    print("OK: startup within budget")
+
+
+if __name__ == "__main__":
+    main()
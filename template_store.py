@@ -0,0 +1,209 @@
+import os
+import hashlib
+import json
+import logging
+import tempfile
+import threading
+import argparse
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from background import file_lock
+
+logger = logging.getLogger(__name__)
+
+CUSTOM_TEMPLATES_DIR = os.path.join('templates', 'custom_templates')
+# Before the index existed, uploads were saved as custom_<timestamp>.html with their subjects in this file
+LEGACY_SUBJECTS_FILE = 'subjects.json'
+
+
+def atomic_write_json(path, data, indent=4):
+    """Write JSON to path via a temp file and rename so readers never see a partial file"""
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp_', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class CustomTemplateStore:
+    """
+    Content-addressed store for uploaded custom templates.
+
+    Templates are named after the SHA-256 of their bytes, so uploading the same
+    file twice reuses the existing copy. A small index (index.json) records the
+    subject and first/last use of each template and drives eviction.
+    """
+
+    def __init__(self, base_dir=CUSTOM_TEMPLATES_DIR):
+        self.base_dir = base_dir
+        self.index_file = os.path.join(base_dir, 'index.json')
+        self.lock_file = os.path.join(base_dir, '.index.lock')
+        self._lock = threading.Lock()
+        if not os.path.exists(base_dir):
+            os.makedirs(base_dir)
+
+    @contextmanager
+    def _locked(self):
+        """Serialize index updates across threads and, where supported, processes"""
+        with self._lock, file_lock(self.lock_file):
+            yield
+
+    def _load_index(self):
+        if not os.path.exists(self.index_file):
+            return {}
+        try:
+            with open(self.index_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read template index, starting fresh: {str(e)}")
+            return {}
+
+    def _path(self, template_name):
+        return os.path.join(self.base_dir, template_name)
+
+    def save(self, content, subject):
+        """
+        Store template bytes and return the path of the stored file.
+        Identical content is written only once; its index entry is refreshed.
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        template_name = f"custom_{digest[:16]}.html"
+        template_path = self._path(template_name)
+        now = datetime.now().isoformat()
+
+        with self._locked():
+            index = self._load_index()
+
+            if not os.path.exists(template_path):
+                fd, tmp_path = tempfile.mkstemp(dir=self.base_dir, prefix='.tmp_', suffix='.html')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(content)
+                os.replace(tmp_path, template_path)
+                logger.info(f"Stored new custom template {template_name}")
+            else:
+                logger.info(f"Reusing existing custom template {template_name}")
+
+            entry = index.get(digest, {'template': template_name, 'first_used': now})
+            entry['subject'] = subject
+            entry['last_used'] = now
+            index[digest] = entry
+            atomic_write_json(self.index_file, index)
+
+        return template_path
+
+    def entries(self):
+        """Return a snapshot of the index"""
+        with self._locked():
+            return self._load_index()
+
+    def _migrate_legacy(self, index):
+        """
+        Add templates saved before the index existed to it, dated by their
+        modification time and with their subject from subjects.json, which is
+        then removed. Eviction then covers them like any other template.
+        Returns True if anything changed.
+        """
+        indexed = {entry['template'] for entry in index.values()}
+        subjects_file = self._path(LEGACY_SUBJECTS_FILE)
+        subjects = {}
+        if os.path.exists(subjects_file):
+            try:
+                with open(subjects_file, 'r') as f:
+                    subjects = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not read legacy template subjects: {str(e)}")
+
+        migrated = 0
+        for name in os.listdir(self.base_dir):
+            if not (name.startswith('custom_') and name.endswith('.html')) or name in indexed:
+                continue
+            used = datetime.fromtimestamp(os.path.getmtime(self._path(name))).isoformat()
+            # Keyed by name: the content digest could clash with a later upload of the same file
+            index[name] = {'template': name, 'subject': subjects.get(name), 'first_used': used, 'last_used': used}
+            migrated += 1
+        if migrated:
+            logger.info(f"Added {migrated} unindexed custom templates to the index")
+        if os.path.exists(subjects_file):
+            os.remove(subjects_file)
+        return migrated > 0
+
+    def evict(self, max_templates=None, max_age_days=None, in_use=()):
+        """
+        Remove templates not used in max_age_days and then the least recently
+        used ones beyond max_templates. Templates in in_use (names or paths,
+        e.g. those pending retries still send from) are never removed.
+        Returns the removed template names.
+        """
+        in_use = {os.path.basename(path) for path in in_use}
+        removed = []
+        removed_names = []
+        with self._locked():
+            index = self._load_index()
+            migrated = self._migrate_legacy(index)
+            by_last_used = sorted(index.items(), key=lambda item: item[1].get('last_used', ''), reverse=True)
+
+            keep = []
+            cutoff = None
+            if max_age_days is not None:
+                cutoff = (datetime.now() - timedelta(days=max_age_days)).isoformat()
+            for digest, entry in by_last_used:
+                if entry['template'] in in_use:
+                    continue
+                if cutoff is not None and entry.get('last_used', '') < cutoff:
+                    removed.append(digest)
+                else:
+                    keep.append(digest)
+            if max_templates is not None and len(keep) > max_templates:
+                removed.extend(keep[max_templates:])
+
+            for digest in removed:
+                entry = index.pop(digest)
+                removed_names.append(entry['template'])
+                template_path = self._path(entry['template'])
+                if os.path.exists(template_path):
+                    os.remove(template_path)
+            if removed or migrated:
+                atomic_write_json(self.index_file, index)
+
+        logger.info(f"Evicted {len(removed_names)} custom templates")
+        return removed_names
+
+    def clear(self):
+        """Remove every stored template and the index"""
+        with self._locked():
+            for name in os.listdir(self.base_dir):
+                if name.endswith('.html') or name in ('index.json', LEGACY_SUBJECTS_FILE):
+                    os.remove(self._path(name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evict stale custom templates')
+    parser.add_argument('--max-templates', type=int, default=None,
+                        help='Keep at most this many of the most recently used templates')
+    parser.add_argument('--max-age-days', type=int, default=None,
+                        help='Remove templates not used in this many days')
+    parser.add_argument('--all', action='store_true', help='Remove every custom template')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    store = CustomTemplateStore()
+    if args.all:
+        store.clear()
+    else:
+        from retry_queue import retry_queue
+        removed = store.evict(max_templates=args.max_templates, max_age_days=args.max_age_days,
+                              in_use=retry_queue.pending_template_paths())
+        for name in removed:
+            print(f"Removed {name}")
+
+
+if __name__ == "__main__":
+    main()
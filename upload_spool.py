@@ -0,0 +1,46 @@
+import os
+import tempfile
+import logging
+
+from flask import Request, current_app
+
+logger = logging.getLogger(__name__)
+
+# Uploaded file parts stay in memory up to this size, then roll over to a temp file
+SPOOL_MEMORY_LIMIT = int(os.getenv('UPLOAD_SPOOL_MEMORY_KB', 1024)) * 1024
+# Directory for spooled uploads (defaults to the system temp dir)
+UPLOAD_TMP_DIR = os.getenv('UPLOAD_TMP_DIR') or None
+
+
+def allow_large_upload(view):
+    """
+    Mark a view as accepting request bodies up to MAX_UPLOAD_LENGTH instead of
+    MAX_CONTENT_LENGTH. Apply it directly below @app.route.
+    """
+    view.allow_large_upload = True
+    return view
+
+
+class SpooledUploadRequest(Request):
+    """
+    Request class for streaming large recipient uploads.
+
+    Werkzeug's multipart parser already reads the body in fixed 64KB chunks;
+    this class decides where those chunks go. Each file part is written to a
+    SpooledTemporaryFile that moves to disk after SPOOL_MEMORY_LIMIT bytes, so
+    memory stays flat however large the upload is. The parsed FileStorage wraps
+    that spool directly and is read from it without another copy.
+    """
+
+    @property
+    def max_content_length(self):
+        if not current_app:
+            return None
+        view = current_app.view_functions.get(self.endpoint) if self.endpoint else None
+        if getattr(view, 'allow_large_upload', False):
+            return current_app.config['MAX_UPLOAD_LENGTH']
+        return current_app.config['MAX_CONTENT_LENGTH']
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        logger.debug(f"Spooling upload {filename} ({total_content_length} byte request)")
+        return tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_LIMIT, mode='rb+', dir=UPLOAD_TMP_DIR)
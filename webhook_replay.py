@@ -0,0 +1,158 @@
+"""
+Replay harness for the SendGrid Event Webhook endpoint.
+
+Posts batches of events (synthetic, or loaded from a JSON/NDJSON file) to
+/webhooks/sendgrid/events as fast as possible and reports the ingestion rate,
+then measures how long the background aggregation takes to catch up.
+In-process runs write to a throwaway events store and recipient history in a
+temporary directory, so the real aggregates and suppressions are untouched.
+
+Usage:
+    python webhook_replay.py --in-process --events 100000
+    python webhook_replay.py --url http://localhost:8000/webhooks/sendgrid/events --threads 8 --token <token>
+    python webhook_replay.py --file captured_events.ndjson --in-process
+"""
+import os
+import sys
+import json
+import time
+import random
+import uuid
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+EVENT_WEIGHTS = [('processed', 30), ('delivered', 30), ('open', 20), ('click', 8),
+                 ('bounce', 4), ('deferred', 4), ('dropped', 2), ('spamreport', 1), ('unsubscribe', 1)]
+TEMPLATES = ['email_template.html', 'template-2.html', 'template-3.html', 'template-4.html']
+
+
+def synthetic_events(count, campaigns):
+    """Generate SendGrid-shaped events spread over a number of campaigns"""
+    campaign_templates = {str(uuid.uuid4()): random.choice(TEMPLATES) for _ in range(campaigns)}
+    campaign_ids = list(campaign_templates)
+    names = [name for name, _ in EVENT_WEIGHTS]
+    weights = [weight for _, weight in EVENT_WEIGHTS]
+    now = int(time.time())
+    for i in range(count):
+        campaign_id = random.choice(campaign_ids)
+        yield {
+            'email': f'user{i}@example.com',
+            'timestamp': now - random.randint(0, 86400),
+            'event': random.choices(names, weights)[0],
+            'sg_event_id': uuid.uuid4().hex,
+            'sg_message_id': uuid.uuid4().hex,
+            'campaign_id': campaign_id,
+            'template': campaign_templates[campaign_id]
+        }
+
+
+def file_events(path):
+    """Load events from a JSON array file or an NDJSON file of events/batches"""
+    with open(path, 'r') as f:
+        if path.endswith('.json'):
+            yield from json.load(f)
+            return
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if isinstance(item, list):
+                yield from item
+            else:
+                yield item
+
+
+def batched(events, size):
+    batch = []
+    for event in events:
+        batch.append(event)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay SendGrid webhook events against the app')
+    parser.add_argument('--url', default='http://localhost:8000/webhooks/sendgrid/events')
+    parser.add_argument('--in-process', action='store_true', help='Use the Flask test client instead of HTTP')
+    parser.add_argument('--file', help='Replay events from a JSON or NDJSON file instead of synthetic ones')
+    parser.add_argument('--events', type=int, default=50000, help='Number of synthetic events')
+    parser.add_argument('--campaigns', type=int, default=50, help='Number of synthetic campaigns')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Events per POST (SendGrid sends up to ~1000)')
+    parser.add_argument('--threads', type=int, default=4, help='Concurrent posters')
+    parser.add_argument('--token', default=os.getenv('SENDGRID_WEBHOOK_TOKEN'),
+                        help='Webhook ?token= (default: SENDGRID_WEBHOOK_TOKEN)')
+    args = parser.parse_args()
+
+    events = file_events(args.file) if args.file else synthetic_events(args.events, args.campaigns)
+    payloads = [json.dumps(batch).encode('utf-8') for batch in batched(events, args.batch_size)]
+    total_events = sum(payload.count(b'"event"') for payload in payloads)
+
+    if args.in_process and not args.token and not os.getenv('SENDGRID_WEBHOOK_PUBLIC_KEY'):
+        # The endpoint refuses unauthenticated events; give the in-process app a throwaway token
+        args.token = uuid.uuid4().hex
+        os.environ['SENDGRID_WEBHOOK_TOKEN'] = args.token
+    query = {'token': args.token} if args.token else {}
+
+    scratch_dir = None
+    if args.in_process:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import app as app_module
+        from event_webhook import EventStore
+        from recipient_history import RecipientHistory
+
+        # Synthetic events would otherwise suppress made-up addresses and add fake campaigns to the
+        # dashboard, so the endpoint is pointed at stores that only live for this run
+        scratch_dir = tempfile.mkdtemp(prefix='webhook_replay_')
+        history = RecipientHistory(os.path.join(scratch_dir, 'recipient_history.db'))
+        event_store = EventStore(os.path.join(scratch_dir, 'events'), history=history)
+        app_module.event_store = event_store
+        client = app_module.app.test_client()
+
+        def post(payload):
+            return client.post('/webhooks/sendgrid/events', data=payload, query_string=query,
+                               content_type='application/json').status_code
+    else:
+        import requests
+        session = requests.Session()
+        event_store = None
+
+        def post(payload):
+            return session.post(args.url, data=payload, params=query,
+                                headers={'Content-Type': 'application/json'}).status_code
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            statuses = list(pool.map(post, payloads))
+        elapsed = time.perf_counter() - start
+
+        failures = [status for status in statuses if status >= 300]
+        print(f"Posted {total_events} events in {len(payloads)} batches in {elapsed:.2f}s "
+              f"({total_events / elapsed:,.0f} events/s)")
+        if failures:
+            print(f"{len(failures)} batches rejected (statuses: {sorted(set(failures))})")
+
+        if event_store is not None:
+            # Wait until the background aggregator (or this call) has consumed every batch
+            while True:
+                processed = event_store.aggregate()
+                if processed == 0:
+                    break
+                if processed is None:
+                    time.sleep(0.05)
+            print(f"Aggregates caught up {time.perf_counter() - start:.2f}s after the first POST")
+    finally:
+        if scratch_dir is not None:
+            event_store.stop()
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()